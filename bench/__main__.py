@@ -0,0 +1,173 @@
+# Offline benchmark of smog's hot paths against a local fake SmugMug.
+#
+#   python -m bench --dirs 20 --files 50 --size 200000 --latency 0.02
+#
+# Generates a synthetic directory tree, then times DirectoryIndex.reindex,
+# a full sync, AlbumIndex.reindex, a no-op sync and the md5 merge-diff,
+# reporting throughput, requests made and peak Python memory for each.
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import trio
+
+from bench.fake_smugmug import FakeSmugMug
+from smog.__main__ import CONCURRENCY, diff_indexes, parse_args, sync
+from smog.api import SmugMugApi
+from smog.index import AlbumImages, AlbumIndex, DirectoryIndex
+
+
+def make_tree(root, num_dirs, num_files, size, seed=0):
+    """Write num_dirs directories of num_files random .jpg files each."""
+    rng = random.Random(seed)
+    dirs = []
+    for i in range(num_dirs):
+        dir_path = os.path.join(root, f'album{i:04}')
+        os.mkdir(dir_path)
+        for j in range(num_files):
+            with open(os.path.join(dir_path, f'img{j:05}.jpg'), 'wb') as f:
+                remaining = size
+                while remaining:
+                    chunk = min(remaining, 1 << 20)
+                    f.write(rng.getrandbits(chunk * 8).to_bytes(chunk, 'little'))
+                    remaining -= chunk
+        dirs.append(dir_path)
+    return dirs
+
+
+class Benchmark(object):
+    def __init__(self, server):
+        self.server = server
+        self.results = []
+
+    async def measure(self, name, items, unit, async_fn, *args):
+        requests = self.server.requests.copy()
+        bytes_received = self.server.bytes_received
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        # smog prints a line per operation
+        with contextlib.redirect_stdout(io.StringIO()):
+            await async_fn(*args)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        result = {
+            'name': name,
+            'seconds': seconds,
+            'items': items,
+            'unit': unit,
+            'throughput': items / seconds if seconds else 0,
+            'requests': dict(self.server.requests - requests),
+            'bytes_uploaded': self.server.bytes_received - bytes_received,
+            'peak_python_memory': peak,
+        }
+        self.results.append(result)
+        print(f'{name:32} {seconds:8.3f}s {result["throughput"]:10.1f} {unit}/s '
+              f'{sum(result["requests"].values()):6} requests '
+              f'{result["bytes_uploaded"] / 1e6:8.1f} MB sent '
+              f'{peak / 1e6:8.1f} MB peak')
+        return result
+
+
+async def reindex_all(indexes):
+    async with trio.open_nursery() as nursery:
+        for index in indexes:
+            nursery.start_soon(index.reindex)
+
+
+async def run_diff(api, dir_index, album_index):
+    async for _ in diff_indexes(api, dir_index, album_index):
+        pass
+
+
+def synthetic_indexes(api, size):
+    # Half the files are already uploaded, and the album has as many images
+    # that are no longer local
+    dir_index = DirectoryIndex('synthetic')
+    dir_index.cache = {(0, 0, f'{i}.jpg'): f'{i * 2:032x}' for i in range(size)}
+    album_index = AlbumIndex('synthetic', api, '/api/v2/album/synthetic')
+    album_index.by_md5 = AlbumImages.from_pairs('/api/v2/album/synthetic/image/', (
+        (f'{i:032x}', f'/api/v2/album/synthetic/image/{i}-0') for i in range(size)))
+    return dir_index, album_index
+
+
+async def run(args):
+    server = FakeSmugMug(latency=args.latency, page_size=args.page_size,
+                         error_rate=args.error_rate)
+    server.add_folder('Bench')
+    bench = Benchmark(server)
+    os.environ.setdefault('ALBUM_PASSWORD', 'bench')
+
+    async with trio.open_nursery() as nursery:
+        listeners = await nursery.start(functools.partial(trio.serve_tcp, server.handle, 0, host='127.0.0.1'))
+        port = listeners[0].socket.getsockname()[1]
+        api = SmugMugApi('consumer key', 'consumer secret', 'token', 'token secret',
+                         requests_per_second=args.requests_per_second)
+        api.BASE_URI = f'http://127.0.0.1:{port}'
+        api.UPLOAD_URI = f'http://127.0.0.1:{port}/'
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tree = os.path.join(tmp, 'tree')
+            index_root = os.path.join(tmp, 'index')
+            os.mkdir(tree)
+            os.mkdir(index_root)
+            dirs = await trio.to_thread.run_sync(make_tree, tree, args.dirs, args.files, args.size)
+            num_files = args.dirs * args.files
+            smog_args = parse_args(['Bench', index_root, *dirs] + (['--sqlite'] if args.sqlite else []))
+
+            hash_limiter = trio.CapacityLimiter(smog_args.hash_workers)
+            await bench.measure('DirectoryIndex.reindex (cold)', num_files, 'files', reindex_all,
+                                [DirectoryIndex(d, hash_limiter) for d in dirs])
+            await bench.measure('DirectoryIndex.reindex (warm)', num_files, 'files', reindex_all,
+                                [DirectoryIndex(d, hash_limiter) for d in dirs])
+
+            async with api.open_sessions(CONCURRENCY):
+                await bench.measure('main (initial sync)', num_files, 'files', sync, api, smog_args)
+                album_endpoints = [node['Uris']['Album'] for node in server.nodes.values()
+                                   if node['Type'] == 'Album']
+                await bench.measure('AlbumIndex.reindex', num_files, 'images', reindex_all,
+                                    [AlbumIndex(os.path.join(tmp, endpoint.split('/')[-1]), api, endpoint)
+                                     for endpoint in album_endpoints])
+                await bench.measure('main (no-op sync)', num_files, 'files', sync, api, smog_args)
+
+            await bench.measure('diff_indexes (synthetic)', args.diff_size, 'files', run_diff,
+                                api, *synthetic_indexes(api, args.diff_size))
+
+        nursery.cancel_scope.cancel()
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{server.connections} connections, peak RSS {maxrss / 1e3:.1f} MB')
+    if args.json:
+        with open(args.json, 'w') as f:
+            for result in bench.results:
+                f.write(json.dumps(result) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench', description='Benchmark smog against a local fake SmugMug.')
+    parser.add_argument('--dirs', type=int, default=10, help='directories to generate')
+    parser.add_argument('--files', type=int, default=50, help='files per directory')
+    parser.add_argument('--size', type=int, default=100000, help='bytes per file')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every response')
+    parser.add_argument('--page-size', type=int, default=100, help='items per listing page')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with 429')
+    parser.add_argument('--requests-per-second', type=float, default=1000,
+                        help='SmugMugApi rate limit (default high so the server is the bottleneck)')
+    parser.add_argument('--diff-size', type=int, default=200000, help='files in the synthetic merge-diff')
+    parser.add_argument('--sqlite', action='store_true', help='sync with --sqlite')
+    parser.add_argument('--json', help='also write results as JSON lines to this file')
+    args = parser.parse_args()
+    tracemalloc.start()
+    trio.run(run, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# Local stand-in for api.smugmug.com and upload.smugmug.com, serving just
+# the endpoints smog uses over plain HTTP. OAuth signatures are not checked.
+
+import collections
+import hashlib
+import json
+import random
+import re
+from urllib.parse import parse_qs, urlsplit
+
+import h11
+import trio
+
+
+class FakeSmugMug(object):
+    def __init__(self, latency=0, page_size=100, error_rate=0, seed=0):
+        self.latency = latency
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        # node id -> node dict, plus the ids of its children
+        self.nodes = {}
+        self.children = collections.defaultdict(list)
+        # albumkey -> list of AlbumImage dicts
+        self.albums = {}
+        self.requests = collections.Counter()
+        self.bytes_received = 0
+        self.connections = 0
+        self.revision = 0
+        self._add_node('root', None, 'Folder', '')
+
+    def _add_node(self, node_id, parent_id, node_type, name):
+        self.revision += 1
+        node = {'NodeID': node_id, 'Name': name, 'Type': node_type,
+                'Uri': f'/api/v2/node/{node_id}', 'Uris': {},
+                'DateModified': str(self.revision)}
+        if node_type == 'Album':
+            node['Uris']['Album'] = f'/api/v2/album/{node_id}'
+            self.albums[node_id] = []
+        self.nodes[node_id] = node
+        if parent_id is not None:
+            self.children[parent_id].append(node_id)
+        return node
+
+    def add_folder(self, name, parent_id='root'):
+        return self._add_node(f'folder{len(self.nodes)}', parent_id, 'Folder', name)
+
+    def remove_node(self, node_id, parent_id):
+        self.children[parent_id].remove(node_id)
+        del self.nodes[node_id]
+        self.albums.pop(node_id, None)
+
+    def add_album(self, name, parent_id):
+        return self._add_node(f'album{len(self.nodes)}', parent_id, 'Album', name)
+
+    def add_image(self, albumkey, md5, image_key=None):
+        image_key = image_key or f'image{sum(map(len, self.albums.values()))}'
+        image = {'ArchivedMD5': md5, 'ImageKey': image_key, 'Keywords': 'smog.upload',
+                 'Uri': f'/api/v2/album/{albumkey}/image/{image_key}-0'}
+        self.albums[albumkey].append(image)
+        self.revision += 1
+        self.nodes[albumkey]['DateModified'] = str(self.revision)
+        return image
+
+    def _page(self, key, items, query):
+        start = int(query.get('start', ['1'])[0])
+        count = int(query.get('count', [str(self.page_size)])[0])
+        page = items[start - 1:start - 1 + count]
+        return {'Response': {key: page, 'Pages': {'Total': len(items), 'Start': start,
+                                                  'Count': len(page), 'RequestedCount': count}}}
+
+    def _respond(self, method, path, query, headers, body, md5):
+        if path == '/api/v2!authuser':
+            self.requests['authuser'] += 1
+            return 200, {'Response': {'User': {'Uris': {'Node': '/api/v2/node/root'}}}}
+        match = re.fullmatch(r'/api/v2/node/(\w+)!children', path)
+        if match and method == 'GET':
+            self.requests['list nodes'] += 1
+            nodes = [self.nodes[child] for child in self.children[match.group(1)]]
+            if query.get('SortMethod') == ['DateModified']:
+                nodes.sort(key=lambda node: int(node['DateModified']), reverse=True)
+            return 200, self._page('Node', nodes, query)
+        if match and method == 'POST':
+            self.requests['create album'] += 1
+            form = parse_qs(body.decode())
+            node = self.add_album(form['Name'][0], match.group(1))
+            return 200, {'Response': {'Node': node}}
+        match = re.fullmatch(r'/api/v2/node/(\w+)', path)
+        if match and method == 'GET':
+            self.requests['get node'] += 1
+            if match.group(1) not in self.nodes:
+                return 404, {}
+            return 200, {'Response': {'Node': self.nodes[match.group(1)]}}
+        match = re.fullmatch(r'/api/v2/album/(\w+)!images', path)
+        if match:
+            self.requests['list images'] += 1
+            images = self.albums[match.group(1)]
+            if '_filter' in query:
+                fields = query['_filter'][0].split(',')
+                images = [{field: image[field] for field in fields if field in image} for image in images]
+            return 200, self._page('AlbumImage', images, query)
+        match = re.fullmatch(r'/api/v2/album/(\w+)!collectimages', path)
+        if match:
+            self.requests['collect images'] += 1
+            for uri in json.loads(body)['CollectUris'].split(','):
+                image_key = uri.split('/')[-1].rsplit('-', 1)[0]
+                image = next(image for images in self.albums.values() for image in images
+                             if image['ImageKey'] == image_key)
+                self.add_image(match.group(1), image['ArchivedMD5'])
+            return 200, {}
+        if method == 'PATCH':
+            self.requests['patch'] += 1
+            match = re.fullmatch(r'/api/v2/album/(\w+)/image/[\w-]+', path)
+            for image in self.albums.get(match.group(1), []) if match else []:
+                if image['Uri'] == path:
+                    image['Keywords'] = json.loads(body)['Keywords']
+            return 200, {}
+        if path == '/' and method == 'POST':
+            self.requests['upload'] += 1
+            if headers.get('content-md5') != md5:
+                return 400, {'Message': 'MD5 mismatch'}
+            albumkey = headers['x-smug-albumuri'].split('/')[-1]
+            image = self.add_image(albumkey, md5)
+            return 200, {'stat': 'ok', 'Image': {'ImageUri': f'/api/v2/image/{image["ImageKey"]}-0',
+                                                 'AlbumImageUri': image['Uri']}}
+        self.requests['not found'] += 1
+        return 404, {}
+
+    async def handle(self, stream):
+        """Serve one connection; pass to trio.serve_tcp."""
+        self.connections += 1
+        conn = h11.Connection(h11.SERVER)
+        while True:
+            request = None
+            body = []
+            md5 = hashlib.md5()
+            while True:
+                event = conn.next_event()
+                if event is h11.NEED_DATA:
+                    try:
+                        data = await stream.receive_some(1 << 16)
+                    except trio.BrokenResourceError:
+                        return
+                    if not data:
+                        return
+                    conn.receive_data(data)
+                elif isinstance(event, h11.Request):
+                    request = event
+                elif isinstance(event, h11.Data):
+                    self.bytes_received += len(event.data)
+                    md5.update(event.data)
+                    # Don't keep upload bodies around
+                    if request.target != b'/':
+                        body.append(bytes(event.data))
+                elif isinstance(event, h11.EndOfMessage):
+                    break
+                elif isinstance(event, h11.ConnectionClosed):
+                    return
+
+            await trio.sleep(self.latency)
+            headers = {name.decode().lower(): value.decode() for name, value in request.headers}
+            response_headers = [('Content-Type', 'application/json')]
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.requests['429'] += 1
+                status, content = 429, {}
+                response_headers.append(('Retry-After', '0'))
+            else:
+                parts = urlsplit(request.target.decode())
+                status, content = self._respond(request.method.decode(), parts.path, parse_qs(parts.query),
+                                                headers, b''.join(body), md5.hexdigest())
+            content = json.dumps(content).encode()
+            response_headers.append(('Content-Length', str(len(content))))
+            await stream.send_all(conn.send(h11.Response(status_code=status, headers=response_headers)))
+            await stream.send_all(conn.send(h11.Data(data=content)))
+            await stream.send_all(conn.send(h11.EndOfMessage()))
+            if conn.our_state is not h11.DONE:
+                await stream.aclose()
+                return
+            conn.start_next_cycle()
@@ -1,60 +1,52 @@
+import argparse
+import importlib
 import itertools
 import logging
 import os
 import re
 import sys
-from async_generator import asynccontextmanager
 
 import trio
 
 from smog.api import SmugMugApi
+from smog.dedupe import DuplicateUploader
+from smog.discover import album_name, find_dirs
 from smog.index import AlbumIndex, DirectoryIndex
+from smog.inotify import Inotify
+from smog.journal import Journal
+from smog.nodes import NodeCache
+from smog.plan import open_planner, read_plan
+from smog.ratelimit import Bandwidth
+from smog.scheduler import ORDERS, open_scheduler
+from smog.shard import Coordinator, in_shard, write_results
+from smog.store import IndexStore
+from smog.throughput import Throughput
+from smog.trace import report_blocking, tracer
+
+
+CONCURRENCY = 8
+# Default cap on the bytes of uploads in flight at once
+UPLOAD_MB = 64
+# Seconds a changed file must go without further changes before --watch
+# uploads it, so files still being written or copied are left alone
+WATCH_QUIET = 5
 
 
-# https://stackoverflow.com/a/48355334
 # This logs and ignores exceptions, which is not really what we want. We want
 # the exceptions to propagate up as a MultiError, but only after all
 # outstanding children have completed without being canceled. I don't think
-# that is easy to express with this approach. We only use this nursery on the
-# last set of operations so we don't silently proceed after an exception.
-class ExceptionLoggingNursery:
-    def __init__(self, nursery):
-        self.nursery = nursery
-
-    @property
-    def cancel_scope(self):
-        return self.nursery.cancel_scope
-
-    async def _run_and_log_errors(self, async_fn, *args):
-        # This is more cumbersome than it should be
-        # See https://github.com/python-trio/trio/issues/408
-        def handler(exc):
-            if not isinstance(exc, Exception):
-                return exc
-            logging.exception("Unhandled exception!", exc_info=exc)
-        with trio.MultiError.catch(handler):
-            return await async_fn(*args)
-
-    def start_soon(self, async_fn, *args, **kwargs):
-        self.nursery.start_soon(self._run_and_log_errors, async_fn, *args, **kwargs)
-
-    async def start(self, async_fn, *args, **kwargs):
-        return await self.nursery.start(self._run_and_log_errors, async_fn, *args, **kwargs)
-
-
-@asynccontextmanager
-async def open_exception_logging_nursery():
-    async with trio.open_nursery() as nursery:
-        yield ExceptionLoggingNursery(nursery)
-
-
-# TODO refactor pagination logic
-async def list_nodes(api, next_page):
-    while next_page:
-        nodes_response = await api.list_nodes(next_page)
-        for node in nodes_response['Response'].get('Node', []):
-            yield node
-        next_page = nodes_response['Response']['Pages'].get('NextPage')
+# that is easy to express with this approach. We only use this on the final
+# upload/removal operations so we don't silently proceed after an exception.
+# See https://stackoverflow.com/a/48355334
+async def run_and_log_errors(async_fn, *args):
+    # This is more cumbersome than it should be
+    # See https://github.com/python-trio/trio/issues/408
+    def handler(exc):
+        if not isinstance(exc, Exception):
+            return exc
+        logging.exception("Unhandled exception!", exc_info=exc)
+    with trio.MultiError.catch(handler):
+        return await async_fn(*args)
 
 
 async def run_operation(limit, progress, msg, fn, *args):
@@ -64,17 +56,259 @@ async def run_operation(limit, progress, msg, fn, *args):
         await fn(*args)
 
 
-async def create_album(api, folder_node_endpoint, album_name, dir_index, index_root, to_sync):
+def upload_operation(uploader, dir_index, album_index, md5, image_filename):
+    image_path = dir_index.dir_path / image_filename
+    return (f'Uploading {image_path}',
+            uploader.upload_image, album_index.album_endpoint, image_path, md5)
+
+
+def removal_operation(api, image_endpoint):
+    # TODO keywords handled sloppily. should add not overwrite. never unset
+    # FYI '-' is silently dropped from keywords
+    return (f'Marking for removal {image_endpoint}',
+            api.set_keywords, image_endpoint, 'smog.upload; smog.removed')
+
+
+async def diff_indexes(api, dir_index, album_index, uploader=None):
+    """Yield operations (msg, fn, *args) that bring the album up to date.
+
+    uploads go through uploader.upload_image, by default api's.
+    """
+    uploader = uploader or api
+    store = dir_index.store
+    if store is not None and store is album_index.store:
+        uploads, removals = await store.diff(dir_index.store_key, album_index.albumkey)
+        seen_md5 = set()
+        for md5, image_filename in uploads:
+            # TODO do something more helpful with duplicates
+            if md5 in seen_md5:
+                print('Skipping duplicate', dir_index.dir_path / image_filename)
+                continue
+            seen_md5.add(md5)
+            yield upload_operation(uploader, dir_index, album_index, md5, image_filename)
+        for _, image_endpoint in removals:
+            yield removal_operation(api, image_endpoint)
+        return
+
+    # list() does not seem to work on async generators
+    dir_by_md5 = [x async for x in dir_index.iter_by_md5()]
+    album_by_md5 = [x async for x in album_index.iter_by_md5()]
+    for x in (dir_by_md5, album_by_md5):
+        x.append(('x', None)) # sentinel
+    dir_idx = album_idx = 0
+    while dir_idx < len(dir_by_md5) and album_idx < len(album_by_md5):
+        dir_md5, image_filename = dir_by_md5[dir_idx]
+        album_md5, image_endpoint = album_by_md5[album_idx]
+        if dir_md5 == album_md5:
+            dir_idx += 1
+            album_idx += 1
+        elif dir_md5 < album_md5:
+            yield upload_operation(uploader, dir_index, album_index, dir_md5, image_filename)
+            dir_idx += 1
+        else:
+            if image_endpoint not in album_index.removed:
+                yield removal_operation(api, image_endpoint)
+            album_idx += 1
+    assert dir_idx == len(dir_by_md5) and album_idx == len(album_by_md5)
+
+
+async def send_operation(scheduler, journal, operation, **upload):
+    if journal is not None:
+        operation = await journal.plan(operation)
+        if operation is None:
+            return
+    scheduler.submit(operation, **upload)
+
+
+async def send_diff(api, dir_index, album_index, scheduler, uploader=None, journal=None):
+    """Send the operations that bring album_index up to date with dir_index."""
+    files = {filename: (size, mtime) for size, mtime, filename in dir_index.cache}
+    invalidated = False
+    async for operation in diff_indexes(api, dir_index, album_index, uploader):
+        if not invalidated:
+            await album_index.invalidate()
+            invalidated = True
+        _, fn, *args = operation
+        upload = {}
+        if fn.__name__ == 'upload_image':
+            size, mtime = files[args[1].name]
+            upload = {'size': size, 'mtime': mtime, 'group': album_index.albumkey}
+        await send_operation(scheduler, journal, operation, **upload)
+
+
+async def sync_album(api, scheduler, dir_index, album_index, uploader=None, journal=None, synced=None):
+    if synced is not None:
+        synced.append((dir_index, album_index))
+    limit, progress = scheduler.metadata_limiter, scheduler.progress
+    progress[1] += 2
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(run_operation, limit, progress,
+                           f'Reindexing {dir_index.dir_path}',
+                           dir_index.reindex)
+        nursery.start_soon(run_operation, limit, progress,
+                           f'Reindexing {album_index.album_endpoint}',
+                           album_index.reindex)
+    if uploader is not None:
+        await uploader.add_album(album_index)
+    await send_diff(api, dir_index, album_index, scheduler, uploader, journal)
+
+
+async def create_album(api, folder_node_endpoint, album_name, dir_index, index_root):
     album_node_response = await api.create_album_node(folder_node_endpoint, album_name)
     album_endpoint = album_node_response['Response']['Node']['Uris']['Album']
     albumkey = album_endpoint.split('/')[-1]
     await dir_index.set_albumkey(albumkey)
-    album_index = AlbumIndex(index_root / albumkey, api, album_endpoint)
-    to_sync.append((dir_index, album_index))
+    return AlbumIndex(index_root / albumkey, api, album_endpoint, store=dir_index.store)
+
+
+async def create_and_sync_album(api, scheduler, folder_node_endpoint, album_name,
+                                dir_index, index_root, uploader=None, journal=None, synced=None):
+    progress = scheduler.progress
+    progress[1] += 1
+    async with scheduler.metadata_limiter:
+        print(f'Creating album {album_name}', progress)
+        progress[0] += 1
+        album_index = await create_album(api, folder_node_endpoint, album_name, dir_index, index_root)
+    await sync_album(api, scheduler, dir_index, album_index, uploader, journal, synced)
+
+
+async def resync_album(api, dir_index, album_index, names, scheduler, uploader=None, journal=None):
+    if names is None:
+        await dir_index.reindex()
+    else:
+        await dir_index.update(names)
+    # Refetch so images uploaded since the last listing are seen
+    album_index.last_updated = None
+    await album_index.reindex()
+    await send_diff(api, dir_index, album_index, scheduler, uploader, journal)
+
+
+async def watch(api, scheduler, synced, uploader=None, journal=None):
+    """Resync albums as files in their directories change, until cancelled.
+
+    Only albums whose directories changed are listed again. The journal keeps
+    operations still in flight from being sent twice.
+    """
+    by_path = {str(dir_index.dir_path): (dir_index, album_index) for dir_index, album_index in synced}
+    # (dir path, name) -> trio.current_time() after which it is quiet; a name
+    # of None reindexes the whole directory
+    pending = {}
+    with Inotify() as inotify:
+        for path in by_path:
+            inotify.add_watch(path)
+        print(f'Watching {len(by_path)} directories')
+        while True:
+            timeout = min(pending.values()) - trio.current_time() if pending else float('inf')
+            with trio.move_on_after(max(timeout, 0)):
+                for path, name in await inotify.read():
+                    if path is None:
+                        pending.update(((path, None), trio.current_time()) for path in by_path)
+                    else:
+                        pending[path, name] = trio.current_time() + WATCH_QUIET
+                continue
+            now = trio.current_time()
+            changed = {}
+            for (path, name), deadline in list(pending.items()):
+                if deadline <= now:
+                    del pending[path, name]
+                    changed.setdefault(path, set()).add(name)
+            for path, names in changed.items():
+                await run_and_log_errors(resync_album, api, *by_path[path], None if None in names else names,
+                                         scheduler, uploader, journal)
+
+
+def bandwidth_period(value):
+    """HH:MM-HH:MM=MB/s -> (start minute, end minute, bytes per second)"""
+    match = re.fullmatch(r'(\d\d?):(\d\d)-(\d\d?):(\d\d)=([\d.]+)', value)
+    if not match:
+        raise argparse.ArgumentTypeError(f'expected HH:MM-HH:MM=MB/s, not {value!r}')
+    start_hour, start_minute, end_hour, end_minute = map(int, match.groups()[:4])
+    return start_hour * 60 + start_minute, end_hour * 60 + end_minute, float(match.group(5)) * 1e6
+
+
+def dir_filter(value):
+    """MODULE:FUNCTION -> the function"""
+    module_name, _, function_name = value.partition(':')
+    if not function_name:
+        raise argparse.ArgumentTypeError(f'expected MODULE:FUNCTION, not {value!r}')
+    try:
+        return getattr(importlib.import_module(module_name), function_name)
+    except (ImportError, AttributeError) as e:
+        raise argparse.ArgumentTypeError(f'cannot load {value!r}: {e}')
+
+
+def shard_number(value):
+    """I/N -> (I, N)"""
+    match = re.fullmatch(r'(\d+)/(\d+)', value)
+    if not match or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f'expected I/N with I < N, not {value!r}')
+    return int(match.group(1)), int(match.group(2))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='smog', description='Sync local directories up to SmugMug.')
+    parser.add_argument('root_folder', help='SmugMug folder to upload into')
+    parser.add_argument('index_root', help='local directory for smog index files')
+    parser.add_argument('dirs', nargs='*', help='directories to upload')
+    parser.add_argument('--root', dest='roots', metavar='DIR', action='append', default=[],
+                        help='also upload every directory with images or videos under DIR')
+    parser.add_argument('--dir-filter', type=dir_filter, default=album_name, metavar='MODULE:FUNCTION',
+                        help='function taking a directory path and returning its album name, '
+                             'or None to skip it (default: smog.discover.album_name)')
+    parser.add_argument('--hash-workers', type=int, default=os.cpu_count() or 1,
+                        help='threads hashing new files (default: number of CPUs)')
+    parser.add_argument('--sqlite', action='store_true',
+                        help='keep all indexes in one SQLite database in index_root')
+    parser.add_argument('--duplicates', choices=('upload', 'collect', 'report'), default='upload',
+                        help='for files already in another album: upload them again (default), '
+                             'collect the existing image into the album, or just report them')
+    parser.add_argument('--requests-per-second', type=float, default=SmugMugApi.REQUESTS_PER_SECOND,
+                        help='most API requests per second; lowered automatically when SmugMug pushes back '
+                             '(default: %(default)s)')
+    parser.add_argument('--upload-mb', type=float, default=UPLOAD_MB,
+                        help='most megabytes of files being uploaded at once; a bigger file is sent on its own '
+                             '(default: %(default)s)')
+    parser.add_argument('--order', choices=ORDERS, default='fifo',
+                        help='which waiting upload goes next: in diff order (default), smallest first, '
+                             'newest first, or one album after another')
+    parser.add_argument('--bandwidth', type=float,
+                        help='most megabytes per second to upload, across all uploads (default: no limit)')
+    parser.add_argument('--bandwidth-schedule', type=bandwidth_period, action='append', default=[],
+                        metavar='HH:MM-HH:MM=MB/S',
+                        help='use a different --bandwidth between these local times, e.g. 09:00-18:00=1; '
+                             'may be given more than once')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a JSON line per API request, directory scan, hash batch and phase to FILE')
+    parser.add_argument('--summary', action='store_true',
+                        help='print request timings, md5 cache hit ratio and phase durations at the end')
+    parser.add_argument('--report-blocking', type=float, metavar='SECONDS',
+                        help='trace tasks that block the event loop for longer than SECONDS')
+    parser.add_argument('--watch', action='store_true',
+                        help='after syncing, keep running and upload changes as they happen (Linux only)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--plan', metavar='FILE',
+                      help='only work out what to send and write it to FILE as JSON, with totals and, '
+                           'given --bandwidth, an estimated duration')
+    mode.add_argument('--apply', metavar='FILE',
+                      help='send what --plan wrote to FILE instead of working it out again')
+    parser.add_argument('--shards', type=int, default=1, metavar='N',
+                        help='split the albums between N processes, sharing the request and bandwidth limits')
+    # Set by --shards for each process it runs
+    parser.add_argument('--shard', type=shard_number, help=argparse.SUPPRESS)
+    parser.add_argument('--shard-results', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.watch and (args.plan or args.apply):
+        parser.error('--watch cannot be used with --plan or --apply')
+    if args.shards > 1 and (args.plan or args.apply):
+        parser.error('--shards cannot be used with --plan or --apply')
+    return args
 
 
 async def main():
-    _, root_folder, index_root, *dirs = sys.argv
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+    if args.shard is not None:
+        split_limits(args, args.shard[1])
 
     oauth_consumer_key = os.environ['SMUGMUG_API_KEY']
     oauth_consumer_secret = os.environ['SMUGMUG_API_SECRET']
@@ -82,114 +316,235 @@ async def main():
     oauth_token_secret = os.environ['SMUGMUG_OAUTH_TOKEN_SECRET']
 
     api = SmugMugApi(oauth_consumer_key, oauth_consumer_secret,
-                     oauth_token, oauth_token_secret)
-    limit = trio.CapacityLimiter(8)
-
-    dir_by_name = {}
-    dir_by_albumkey = {}
-    for dir_path in dirs:
-        dir_index = DirectoryIndex(dir_path)
-        dir_name = dir_index.dir_path.name
-        if re.fullmatch(r'\d{3}\w{5}', dir_name):
-            print(f'Ignoring directory that looks like a DCIM directory {dir_path}')
-            continue
-        elif re.fullmatch(r'New folder.*', dir_name) or '*' in dir_path:
-            print(f'Ignoring {dir_path}')
-            continue
-        albumkey = await dir_index.get_albumkey()
-        if albumkey is None:
-            dir_by_name[dir_name] = dir_index
-        elif albumkey in dir_by_albumkey:
-            raise Exception('duplicate album key', albumkey)
-        else:
-            dir_by_albumkey[albumkey] = dir_index
-
-    to_sync = []
-    index_root = trio.Path(index_root)
-    authuser_response = await api.get_authuser()
-    folder_node_endpoint = authuser_response['Response']['User']['Uris']['Node']
-    while root_folder:
-        if not root_folder.endswith('/'):
-            root_folder += '/'
-        next_part, root_folder = root_folder.split('/', 1)
-        async for node in list_nodes(api, folder_node_endpoint):
-            if node['Name'] == next_part:
-                folder_node_endpoint = node['Uri']
-                break
-        else:
-            raise Exception('No folder', next_part)
-
-    async for node in list_nodes(api, folder_node_endpoint):
-        if node['Type'] != 'Album':
-            continue
-        albumkey = node['Uris']['Album'].split('/')[-1]
-        album_index = AlbumIndex(index_root / albumkey, api, node['Uris']['Album'])
-        # TODO unhandled edge case where albumkey misses but name hits
-        if albumkey in dir_by_albumkey:
-            dir_index = dir_by_albumkey.pop(albumkey)
-            to_sync.append((dir_index, album_index))
-        elif node['Name'] in dir_by_name:
-            dir_index = dir_by_name.pop(node['Name'])
-            to_sync.append((dir_index, album_index))
-        else:
-            print(f'Marking for removal /api/v2/album/{albumkey}')
-            await api.set_keywords('/api/v2/album/' + albumkey, 'smog.upload; smog.removed')
-
-    progress = [0, len(dir_by_albumkey) + len(dir_by_name)]
-    async with trio.open_nursery() as nursery:
-        for dir_index in itertools.chain(dir_by_albumkey.values(), dir_by_name.values()):
-            album_name = dir_index.dir_path.name
-            if album_name == 'darktable_exported':
-                album_name = f'{dir_index.dir_path.parent.name}/{album_name}'
-            nursery.start_soon(run_operation, limit, progress,
-                               f'Creating album {album_name}',
-                               create_album, api, folder_node_endpoint, album_name, dir_index, index_root, to_sync)
-
-    progress = [0, 2 * len(to_sync)]
-    async with trio.open_nursery() as nursery:
-        for dir_index, album_index in to_sync:
-            nursery.start_soon(run_operation, limit, progress,
-                               f'Reindexing {dir_index.dir_path}',
-                               dir_index.reindex)
-            nursery.start_soon(run_operation, limit, progress,
-                               f'Reindexing {album_index.album_endpoint}',
-                               album_index.reindex)
-
-    operations = []
-    for dir_index, album_index in to_sync:
-        # list() does not seem to work on async generators
-        dir_by_md5 = [x async for x in dir_index.iter_by_md5()]
-        album_by_md5 = [x async for x in album_index.iter_by_md5()]
-        for x in (dir_by_md5, album_by_md5):
-            x.append(('x', None)) # sentinel
-        dir_idx = album_idx = 0
-        while dir_idx < len(dir_by_md5) and album_idx < len(album_by_md5):
-            dir_md5, image_filename = dir_by_md5[dir_idx]
-            album_md5, image_endpoint = album_by_md5[album_idx]
-            if dir_md5 == album_md5:
-                dir_idx += 1
-                album_idx += 1
-            elif dir_md5 < album_md5:
-                image_path = dir_index.dir_path / image_filename
-                operations.append((f'Uploading {image_path}',
-                                   api.upload_image, album_index.album_endpoint, image_path))
-                dir_idx += 1
+                     oauth_token, oauth_token_secret, args.requests_per_second)
+    if args.trace:
+        tracer.open(args.trace)
+    if args.report_blocking:
+        report_blocking(args.report_blocking)
+    try:
+        async with api.open_sessions(CONCURRENCY):
+            if args.shards > 1 and args.shard is None:
+                await coordinate(api, args, argv)
             else:
-                # TODO keywords handled sloppily. should add not overwrite. never unset
-                # FYI '-' is silently dropped from keywords
-                operations.append((f'Marking for removal {image_endpoint}',
-                                   api.set_keywords, image_endpoint, 'smog.upload; smog.removed'))
-                album_idx += 1
-        assert dir_idx == len(dir_by_md5) and album_idx == len(album_by_md5)
-
-    # TODO this is such a janky and probably incorrectly synchronized way to share data
-    progress = [0, len(operations)]
-    async with open_exception_logging_nursery() as nursery:
-        for msg, fn, *args in operations:
-            nursery.start_soon(run_operation, limit, progress, msg, fn, *args)
+                await sync(api, args)
+    finally:
+        tracer.close()
+        if args.summary:
+            print('\n'.join(tracer.summary()))
 
+
+def split_limits(args, shards):
+    """Give one of shards processes its share of the limits in args."""
+    args.requests_per_second /= shards
+    args.bandwidth = args.bandwidth and args.bandwidth / shards
+    args.bandwidth_schedule = [(start, end, rate / shards) for start, end, rate in args.bandwidth_schedule]
+    args.upload_mb /= shards
+    args.hash_workers = max(1, args.hash_workers // shards)
+
+
+async def coordinate(api, args, argv):
+    """Sync with one process per shard and print their merged totals."""
+    # Shards only read the node cache, so bring it up to date first
+    node_cache = NodeCache(trio.Path(args.index_root) / 'nodes')
+    with tracer.span('phase', 'find folder'):
+        await node_cache.load()
+        await node_cache.list_children(api, await node_cache.find_folder(api, args.root_folder))
+        await node_cache.save()
+
+    started = trio.current_time()
+    coordinator = Coordinator(argv, args.shards, args.index_root)
+    throughput = await coordinator.run()
+    elapsed = trio.current_time() - started
+    for albumkey, sent, planned in throughput.album_totals():
+        print(f'{albumkey}: {sent:.1f} MB sent for {planned:.1f} MB of files')
+    sent = sum(throughput.sent_bytes.values())
+    print(f'{sent / 1e6:.1f} of {sum(throughput.planned.values()) / 1e6:.1f} MB sent in {elapsed:.0f}s, '
+          f'{sent / 1e6 / max(elapsed, 1e-3):.2f} MB/s')
+    if coordinator.failed:
+        raise Exception('shards failed', coordinator.failed)
+
+
+async def sync(api, args):
+    index_root = trio.Path(args.index_root)
+    store = IndexStore(index_root / 'smog.sqlite') if args.sqlite else None
+    try:
+        if args.plan:
+            # Nothing is sent, so nothing goes in the journal
+            await sync_dirs(api, args, store, None)
+            return
+        # Each shard keeps its own journal
+        journal = Journal(index_root / ('journal' if args.shard is None else f'journal.{args.shard[0]}'))
+        await journal.open()
+        try:
+            if args.apply:
+                await apply_plan(api, args, store, journal)
+            else:
+                await sync_dirs(api, args, store, journal)
+        except BaseException:
+            # Keep the whole journal for the next run
+            with trio.CancelScope(shield=True):
+                await journal.close(compact=False)
+            raise
+        await journal.close()
+    finally:
+        if store is not None:
+            with trio.CancelScope(shield=True):
+                await store.close()
     print('done')
 
 
+async def sync_dirs(api, args, store, journal):
+    hash_limiter = trio.CapacityLimiter(args.hash_workers)
+    index_root = trio.Path(args.index_root)
+    uploader = None
+    if args.duplicates != 'upload':
+        uploader = DuplicateUploader(api, args.duplicates, store)
+
+    with tracer.span('phase', 'find directories'):
+        dir_by_name, dir_by_albumkey = await find_dirs(args.dirs, args.roots, hash_limiter, store,
+                                                       args.dir_filter)
+
+    node_cache = NodeCache(index_root / 'nodes')
+    with tracer.span('phase', 'find folder'):
+        await node_cache.load()
+        folder_node_endpoint = await node_cache.find_folder(api, args.root_folder)
+        nodes = await node_cache.list_children(api, folder_node_endpoint)
+        if args.shard is None:
+            await node_cache.save()
+
+    # Each album flows through reindex -> diff -> operations on its own, so
+    # uploads start as soon as the first album is diffed. Keyword and other
+    # API calls run in their own lane so they aren't stuck behind uploads.
+    # With --plan the operations are written out by a Planner instead.
+    synced = []
+    api.bandwidth = Bandwidth(args.bandwidth and args.bandwidth * 1e6, args.bandwidth_schedule)
+    api.throughput = throughput = Throughput()
+    if args.plan:
+        open_lanes = open_planner(args.plan, CONCURRENCY, folder_node_endpoint,
+                                  args.bandwidth and args.bandwidth * 1e6, args.requests_per_second)
+    else:
+        open_lanes = open_scheduler(CONCURRENCY, CONCURRENCY, int(args.upload_mb * 1e6), args.order, throughput)
+    with tracer.span('phase', 'sync'):
+        async with open_lanes as scheduler:
+            # Until every album is diffed; uploads may still be running
+            with tracer.span('phase', 'diff albums'):
+                async with trio.open_nursery() as albums:
+                    for node in nodes:
+                        if node['Type'] != 'Album':
+                            continue
+                        albumkey = node['Uris']['Album'].split('/')[-1]
+                        album_index = AlbumIndex(index_root / albumkey, api, node['Uris']['Album'],
+                                                 node.get('DateModified'), store)
+                        # TODO unhandled edge case where albumkey misses but name hits
+                        if albumkey in dir_by_albumkey:
+                            dir_index = dir_by_albumkey.pop(albumkey)
+                        elif node['Name'] in dir_by_name:
+                            dir_index = dir_by_name.pop(node['Name'])
+                        else:
+                            dir_index = None
+                        # Every shard matches every album, so each
+                        # directory is paired the same way in all of them
+                        if not in_shard(args.shard, albumkey):
+                            continue
+                        if dir_index is None:
+                            await send_operation(scheduler, journal,
+                                                 (f'Marking for removal /api/v2/album/{albumkey}',
+                                                  api.set_keywords, '/api/v2/album/' + albumkey,
+                                                  'smog.upload; smog.removed'))
+                            continue
+                        if args.plan:
+                            scheduler.add_album(album_index.album_endpoint)
+                        if uploader is not None:
+                            # Albums being removed are left out, so nothing is
+                            # collected from them
+                            await uploader.add_album(album_index)
+                        albums.start_soon(sync_album, api, scheduler, dir_index, album_index, uploader, journal, synced)
+
+                    for dir_index in itertools.chain(dir_by_albumkey.values(), dir_by_name.values()):
+                        if not in_shard(args.shard, dir_index.album_name):
+                            continue
+                        if args.plan:
+                            albums.start_soon(scheduler.add_new_album, dir_index.album_name, dir_index)
+                            continue
+                        albums.start_soon(create_and_sync_album, api, scheduler, folder_node_endpoint,
+                                          dir_index.album_name, dir_index, index_root, uploader, journal,
+                                          synced)
+            if args.watch:
+                await watch(api, scheduler, synced, uploader, journal)
+    if not args.plan:
+        print_totals(throughput)
+    if args.shard_results:
+        await write_results(args.shard_results, scheduler.progress, throughput)
+
+
+def print_totals(throughput):
+    for albumkey, sent, planned in throughput.album_totals():
+        print(f'{albumkey}: {sent:.1f} MB sent for {planned:.1f} MB of files')
+    print(throughput.summary())
+
+
+async def send_planned_upload(scheduler, journal, uploader, album_endpoint, upload):
+    image_path = trio.Path(upload['path'])
+    await send_operation(scheduler, journal,
+                         (f'Uploading {image_path}', uploader.upload_image, album_endpoint, image_path, upload['md5']),
+                         size=upload['size'], mtime=upload['mtime'], group=album_endpoint.split('/')[-1])
+
+
+async def create_and_apply_album(api, scheduler, folder_node_endpoint, create, index_root, store,
+                                 uploader, journal):
+    progress = scheduler.progress
+    progress[1] += 1
+    async with scheduler.metadata_limiter:
+        print(f'Creating album {create["name"]}', progress)
+        progress[0] += 1
+        album_index = await create_album(api, folder_node_endpoint, create['name'],
+                                         DirectoryIndex(create['dir'], store=store), index_root)
+    for upload in create['uploads']:
+        await send_planned_upload(scheduler, journal, uploader, album_index.album_endpoint, upload)
+
+
+async def apply_plan(api, args, store, journal):
+    """Run the operations in a plan written by --plan, without diffing again.
+
+    Uploads carry the md5 from planning, so a file changed since then fails
+    to upload rather than sending something that wasn't planned.
+    """
+    plan = await read_plan(args.apply)
+    index_root = trio.Path(args.index_root)
+    operations = plan['operations']
+    uploader = api
+    if args.duplicates != 'upload':
+        uploader = DuplicateUploader(api, args.duplicates, store)
+        for album_endpoint in plan['albums']:
+            await uploader.add_album(AlbumIndex(index_root / album_endpoint.split('/')[-1], api,
+                                                album_endpoint, store=store))
+
+    # The listings of albums the plan changes are out of date
+    touched = {op['album'] for op in operations if op['op'] == 'upload'}
+    touched |= {op['uri'].split('/image/')[0] for op in operations
+                if op['op'] == 'keywords' and '/image/' in op['uri']}
+    for album_endpoint in touched:
+        await AlbumIndex(index_root / album_endpoint.split('/')[-1], api, album_endpoint, store=store).invalidate()
+
+    api.bandwidth = Bandwidth(args.bandwidth and args.bandwidth * 1e6, args.bandwidth_schedule)
+    api.throughput = throughput = Throughput()
+    with tracer.span('phase', 'apply'):
+        async with open_scheduler(CONCURRENCY, CONCURRENCY, int(args.upload_mb * 1e6), args.order,
+                                  throughput) as scheduler:
+            async with trio.open_nursery() as albums:
+                for op in operations:
+                    if op['op'] == 'upload':
+                        await send_planned_upload(scheduler, journal, uploader, op['album'], op)
+                    elif op['op'] == 'keywords':
+                        await send_operation(scheduler, journal, (f'Setting keywords {op["uri"]}',
+                                                                  api.set_keywords, op['uri'], op['keywords']))
+                    elif op['op'] == 'create':
+                        albums.start_soon(create_and_apply_album, api, scheduler, plan['folder'], op,
+                                          index_root, store, uploader, journal)
+                    else:
+                        raise Exception('unknown operation in plan', op)
+    print_totals(throughput)
+
+
 if __name__ == '__main__':
     trio.run(main)
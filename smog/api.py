@@ -1,22 +1,186 @@
-import hashlib
+import email.utils
+import functools
+import itertools
 import mimetypes
 import os
+import random
+import re
+import time
 from json import dumps as json_dumps
+from urllib.parse import urlencode, urlsplit
 
 import asks
+import asks.errors
+import h11
 import oauthlib.oauth1
 import trio
+from async_generator import asynccontextmanager
+
+from smog import http
+from smog.hashing import md5_path
+from smog.ratelimit import TokenBucket
+from smog.trace import tracer
+
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# PATCH is included because we only ever PATCH fields to fixed values
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'PATCH'}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+CONNECTION_ERRORS = (OSError, trio.BrokenResourceError, h11.ProtocolError,
+                     asks.errors.ConnectivityError, asks.errors.BadHttpResponse)
+
+
+def _parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta or HTTP date)."""
+    if not value:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+def _parse_float(value):
+    """float(value), or None if the header is missing or malformed."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def endpoint_class(uri):
+    """/api/v2/album/abc!images?start=1 -> /api/v2/album/*!images, for tracing"""
+    path = urlsplit(uri).path
+    if path == '/':
+        return 'upload'
+    return re.sub(r'/(node|album|image|folder|user)/[^/!]+', r'/\1/*', path)
+
+
+def _body_size(body):
+    if isinstance(body, FileBody):
+        return body.size
+    if isinstance(body, dict):
+        body = urlencode(body)
+    return len(body or '')
+
+
+def _page_query(start, count):
+    if start is None:
+        return ''
+    return f'?start={start}&count={count}'
+
+
+class FileBody(object):
+    """Request body read from disk in bounded chunks.
+
+    Each iteration reopens the file, so the body can be sent more than once.
+    Each chunk waits for bandwidth (a ratelimit.Bandwidth) if given, and
+    on_sent(len(chunk)) is called once the consumer asks for the next one.
+    """
+    def __init__(self, path, size, chunk_size=UPLOAD_CHUNK_SIZE, bandwidth=None, on_sent=None):
+        self.path = trio.Path(path)
+        self.size = size
+        self.chunk_size = chunk_size
+        self.bandwidth = bandwidth
+        self.on_sent = on_sent
+
+    async def _chunks(self):
+        async with await self.path.open('rb') as f:
+            while True:
+                chunk = await f.read(self.chunk_size)
+                if not chunk:
+                    break
+                if self.bandwidth is not None:
+                    await self.bandwidth.acquire(len(chunk))
+                yield chunk
+                if self.on_sent is not None:
+                    self.on_sent(len(chunk))
+
+    def __aiter__(self):
+        return self._chunks()
 
 
 class SmugMugApi(object):
     BASE_URI = 'https://api.smugmug.com'
+    UPLOAD_URI = 'https://upload.smugmug.com/'
+    # Only a ceiling; 429s and X-RateLimit headers bring the rate down to
+    # whatever the server tolerates
+    REQUESTS_PER_SECOND = 100
+    MAX_RETRIES = 5
+    BACKOFF_BASE = 0.5
+    MAX_BACKOFF = 60
+    PAGE_BATCH = 8
 
     def __init__(self, oauth_consumer_key, oauth_consumer_secret,
-                 oauth_token, oauth_token_secret, **oauth_kwargs):
+                 oauth_token, oauth_token_secret, requests_per_second=None, **oauth_kwargs):
         self.client = oauthlib.oauth1.Client(
             oauth_consumer_key, client_secret=oauth_consumer_secret,
             resource_owner_key=oauth_token, resource_owner_secret=oauth_token_secret,
             **oauth_kwargs)
+        self.session = None
+        self.upload_session = None
+        # Optional ratelimit.Bandwidth shared by all uploads and
+        # throughput.Throughput counting the bytes they send
+        self.bandwidth = None
+        self.throughput = None
+        self.rate_limiter = TokenBucket(requests_per_second or self.REQUESTS_PER_SECOND)
+
+    @asynccontextmanager
+    async def open_sessions(self, connections):
+        """Reuse up to connections connections per host until exit.
+
+        Outside of this, every request opens a new connection.
+        """
+        self.session = asks.Session(self.BASE_URI, connections=connections)
+        self.upload_session = http.Session(self.UPLOAD_URI, connections=connections)
+        try:
+            yield self
+        finally:
+            session, self.session = self.session, None
+            upload_session, self.upload_session = self.upload_session, None
+            with trio.CancelScope(shield=True):
+                await session.close()
+                await upload_session.aclose()
+
+    async def _send(self, method, uri, headers, body):
+        if isinstance(body, FileBody):
+            # oauthlib barfs on non-UTF8 file upload bodies. These bodies are
+            # unsigned in OAuth anyway.
+            uri, headers, _ = self.client.sign(uri, http_method=method, headers=headers)
+            request = self.upload_session.request if self.upload_session else http.request
+            return await request(method, uri, headers=headers, body=body)
+        uri, headers, body = self.client.sign(uri, http_method=method,
+                                              headers=headers, body=body)
+        request = self.session.request if self.session else asks.request
+        return await request(method, uri, headers=headers, data=body)
+
+    def _update_rate_limit(self, response):
+        """Adapt the request rate to response; return seconds to wait."""
+        retry_after = _parse_retry_after(response.headers.get('retry-after'))
+        if response.status_code in (429, 503):
+            self.rate_limiter.slow_down()
+            self.rate_limiter.pause(retry_after)
+            return retry_after
+        remaining = _parse_float(response.headers.get('x-ratelimit-remaining'))
+        reset = _parse_float(response.headers.get('x-ratelimit-reset'))
+        if remaining is not None and reset is not None and remaining <= 0:
+            # Some APIs send an epoch timestamp, others seconds from now
+            if reset > 1e9:
+                reset -= time.time()
+            self.rate_limiter.pause(max(0, reset))
+        elif 200 <= response.status_code < 300:
+            self.rate_limiter.speed_up()
+        return retry_after
+
+    async def _backoff(self, attempt, at_least=0):
+        # Full jitter so concurrent retries spread out instead of stampeding
+        delay = random.uniform(0, min(self.MAX_BACKOFF, self.BACKOFF_BASE * 2 ** attempt))
+        await trio.sleep(max(at_least, delay))
 
     async def _request_json(self, method, uri, headers=None, body=None, json=None):
         if uri.startswith('/'):
@@ -25,29 +189,88 @@ class SmugMugApi(object):
         if headers is None:
             headers = {}
         headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip', **headers}
-
-        if type(body) == bytes:
-            # oauthlib barfs on non-UTF8 file upload bodies. These bodies are
-            # unsigned in OAuth anyway.
-            uri, headers, _ = self.client.sign(uri, http_method=method, headers=headers)
-        else:
+        if not isinstance(body, FileBody):
             assert body is None or json is None
             if json is not None:
                 body = json_dumps(json)
-            uri, headers, body = self.client.sign(uri, http_method=method,
-                                                  headers=headers, body=body)
 
-        response = await asks.request(method, uri, headers=headers, data=body)
-        # TODO could do advanced rate limiting with response headers
-        if not (200 <= response.status_code < 300):
+        with tracer.span('request', f'{method} {endpoint_class(uri)}') as fields:
+            fields['retries'] = 0
+            response = await self._request_with_retries(method, uri, headers, body, fields)
+            fields['status'] = response.status_code
+            fields['received'] = len(response.content)
+            fields['sent'] = _body_size(body)
+            tracer.count('bytes sent', fields['sent'])
+            tracer.count('bytes received', fields['received'])
+            if 200 <= response.status_code < 300:
+                return response.json()
             raise Exception('HTTP error', response.status_code, response.content)
-        return response.json()
+
+    async def _request_with_retries(self, method, uri, headers, body, fields):
+        # A 429 means the request was not processed, so it is safe to retry
+        # any method. Other failures may have had side effects.
+        for attempt in itertools.count():
+            fields['retries'] = attempt
+            if attempt:
+                tracer.count('retries')
+            can_retry = attempt < self.MAX_RETRIES
+            await self.rate_limiter.acquire()
+            try:
+                response = await self._send(method, uri, headers, body)
+            except CONNECTION_ERRORS:
+                if not (can_retry and method in IDEMPOTENT_METHODS):
+                    raise
+                await self._backoff(attempt)
+                continue
+            retry_after = self._update_rate_limit(response)
+            if can_retry and (response.status_code == 429 or
+                              response.status_code in RETRY_STATUS_CODES and method in IDEMPOTENT_METHODS):
+                await self._backoff(attempt, retry_after)
+                continue
+            return response
 
     async def get_authuser(self):
         return await self._request_json('GET', '/api/v2!authuser')
 
-    async def list_nodes(self, folder_node_endpoint):
-        return await self._request_json('GET', folder_node_endpoint + '!children')
+    async def _iter_pages(self, list_fn, endpoint, key):
+        """Yield every item under key from all pages of list_fn(endpoint).
+
+        The first page tells us the total and page size, so the remaining
+        pages are requested PAGE_BATCH at a time concurrently.
+        """
+        response = (await list_fn(endpoint))['Response']
+        for item in response.get(key, []):
+            yield item
+        pages = response.get('Pages', {})
+        page_size = pages.get('RequestedCount') or pages.get('Count')
+        if not page_size:
+            return
+        starts = list(range(pages['Start'] + page_size, pages['Total'] + 1, page_size))
+        for batch_idx in range(0, len(starts), self.PAGE_BATCH):
+            batch = starts[batch_idx:batch_idx + self.PAGE_BATCH]
+            results = [None] * len(batch)
+            async def fetch(i, start):
+                results[i] = (await list_fn(endpoint, start, page_size))['Response'].get(key, [])
+            # Don't yield inside the nursery; the caller may stop early
+            async with trio.open_nursery() as nursery:
+                for i, start in enumerate(batch):
+                    nursery.start_soon(fetch, i, start)
+            for items in results:
+                for item in items:
+                    yield item
+
+    async def get_node(self, node_endpoint):
+        return await self._request_json('GET', node_endpoint)
+
+    async def list_nodes(self, folder_node_endpoint, start=None, count=None, newest_first=False):
+        query = _page_query(start, count)
+        if newest_first:
+            query += ('&' if query else '?') + 'SortDirection=Descending&SortMethod=DateModified'
+        return await self._request_json('GET', folder_node_endpoint + '!children' + query)
+
+    async def iter_nodes(self, folder_node_endpoint):
+        async for node in self._iter_pages(self.list_nodes, folder_node_endpoint, 'Node'):
+            yield node
 
     async def create_album_node(self, folder_node_endpoint, album_name):
         return await self._request_json('POST', folder_node_endpoint + '!children',
@@ -58,8 +281,24 @@ class SmugMugApi(object):
                                               'Password': os.environ['ALBUM_PASSWORD'],
                                               'Keywords': 'smog.upload'})
 
-    async def list_images(self, album_endpoint):
-        return await self._request_json('GET', album_endpoint + '!images')
+    async def list_images(self, album_endpoint, start=None, count=None, fields=None):
+        """List one page of an album's images; pass fields to get only
+        those fields of each image and none of its Uris."""
+        query = _page_query(start, count)
+        if fields is not None:
+            query += ('&' if query else '?') + '_filter=' + ','.join(fields) + '&_filteruri='
+        return await self._request_json('GET', album_endpoint + '!images' + query)
+
+    async def iter_images(self, album_endpoint, fields=None):
+        list_images = functools.partial(self.list_images, fields=fields)
+        async for image in self._iter_pages(list_images, album_endpoint, 'AlbumImage'):
+            yield image
+
+    async def collect_images(self, album_endpoint, image_uris):
+        """Add existing images (/api/v2/image/...) to an album without uploading"""
+        return await self._request_json('POST', album_endpoint + '!collectimages',
+                                        headers={'Content-Type': 'application/json'},
+                                        json={'CollectUris': ','.join(image_uris)})
 
     async def set_keywords(self, endpoint, keywords):
         """Set keywords for album or image endpoint"""
@@ -67,21 +306,33 @@ class SmugMugApi(object):
                                         headers={'Content-Type': 'application/json'},
                                         json={'Keywords': keywords})
 
-    async def upload_image(self, album_endpoint, image_path):
+    async def upload_image(self, album_endpoint, image_path, md5=None):
+        """Upload image_path, streaming it from disk.
+
+        Pass md5 if it is already known (e.g. from DirectoryIndex) to avoid
+        reading the file an extra time.
+        """
         image_path = trio.Path(image_path)
         content_type, _ = mimetypes.guess_type(image_path.name)
-        body = await image_path.read_bytes()
+        stat = await image_path.stat()
+        on_sent = None
+        if self.throughput is not None:
+            albumkey = album_endpoint.split('/')[-1]
+            on_sent = lambda size: self.throughput.sent(albumkey, size)
+        body = FileBody(image_path, stat.st_size, bandwidth=self.bandwidth, on_sent=on_sent)
+        if md5 is None:
+            md5 = await md5_path(image_path)
         headers = {
-            'Content-Length': str(len(body)),
+            'Content-Length': str(body.size),
             'Content-Type': content_type,
-            'Content-MD5': hashlib.md5(body).hexdigest(),
+            'Content-MD5': md5,
             'X-Smug-AlbumUri': album_endpoint,
             'X-Smug-FileName': image_path.name,
             'X-Smug-Keywords': 'smog.upload',
             'X-Smug-ResponseType': 'JSON',
             'X-Smug-Version': 'v2',
         }
-        return await self._request_json('POST', 'https://upload.smugmug.com/',
+        return await self._request_json('POST', self.UPLOAD_URI,
                                         headers=headers, body=body)
 
 
@@ -0,0 +1,76 @@
+import trio
+
+from smog.journal import NOT_DONE
+
+
+def image_uri(album_image_uri):
+    """/api/v2/album/<albumkey>/image/<imagekey> -> /api/v2/image/<imagekey>"""
+    return '/api/v2/image/' + album_image_uri.split('/')[-1]
+
+
+class DuplicateUploader(object):
+    """Stands in for SmugMugApi.upload_image, avoiding re-sending bytes that
+    already exist in some album.
+
+    Knows md5 -> album image URI for every album passed to add_album plus
+    everything uploaded during this run. Images marked for removal are never
+    reused. mode is 'collect' to collect the existing image into the target
+    album or 'report' to only print it.
+
+    A collected image is the same image in both albums, keywords included,
+    so marking it for removal in one album marks it in the other too.
+    """
+    def __init__(self, api, mode, store=None):
+        self.api = api
+        self.mode = mode
+        self.store = store
+        self.uris = {}
+        # With a store, only album keys are kept and uris are looked up there
+        self.albumkeys = set()
+        # md5 -> trio.Event for uploads in flight, so a second album waits
+        # for the first upload instead of sending the same bytes in parallel
+        self.uploading = {}
+
+    async def add_album(self, album_index):
+        """Learn an album that is being synced, from its last listing if it
+        has not been reindexed yet."""
+        self.albumkeys.add(album_index.albumkey)
+        if self.store is not None:
+            return
+        await album_index.load_cached()
+        for md5, uri in album_index.by_md5:
+            if uri not in album_index.removed:
+                self.uris.setdefault(md5, uri)
+
+    async def _find(self, md5):
+        if md5 in self.uploading:
+            await self.uploading[md5].wait()
+        if md5 in self.uris:
+            return self.uris[md5]
+        if self.store is not None:
+            for albumkey, uri in await self.store.find_images(md5):
+                if albumkey in self.albumkeys:
+                    return uri
+        return None
+
+    async def upload_image(self, album_endpoint, image_path, md5):
+        uri = await self._find(md5)
+        # Another task may have started uploading md5 while we looked
+        while uri is None and md5 in self.uploading:
+            uri = await self._find(md5)
+        if uri is not None:
+            if self.mode == 'report':
+                print(f'Not uploading {image_path}, already uploaded as {uri}')
+                return NOT_DONE
+            print(f'Collecting {uri} for {image_path}')
+            await self.api.collect_images(album_endpoint, [image_uri(uri)])
+            return
+        self.uploading[md5] = trio.Event()
+        try:
+            response = await self.api.upload_image(album_endpoint, image_path, md5)
+            uri = response.get('Image', {}).get('AlbumImageUri')
+            if uri is not None:
+                self.uris[md5] = uri
+        finally:
+            self.uploading.pop(md5).set()
+        return response
@@ -0,0 +1,94 @@
+import os
+import re
+
+import trio
+
+from smog.index import INDEXED_SUFFIXES, DirectoryIndex
+
+
+def album_name(dir_path):
+    """Default directory filter: the album name for dir_path, or None to skip it."""
+    dir_name = os.path.basename(os.path.normpath(dir_path))
+    if re.fullmatch(r'\d{3}\w{5}', dir_name):
+        print(f'Ignoring directory that looks like a DCIM directory {dir_path}')
+        return None
+    if re.fullmatch(r'New folder.*', dir_name) or '*' in dir_path:
+        print(f'Ignoring {dir_path}')
+        return None
+    if dir_name == 'darktable_exported':
+        return f'{os.path.basename(os.path.dirname(os.path.normpath(dir_path)))}/{dir_name}'
+    return dir_name
+
+
+def list_dir(dir_path):
+    """Return (subdirectories, whether there are files to index) of dir_path.
+
+    Hidden entries, like .smog, are skipped. Blocking.
+    """
+    subdirs = []
+    has_files = False
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif os.path.splitext(entry.name)[1].lower() in INDEXED_SUFFIXES:
+                has_files = True
+    return subdirs, has_files
+
+
+async def walk(root, limiter=None):
+    """Return every directory under root, root included, with files to
+    index. Directories are listed in worker threads in parallel."""
+    found = []
+    async def visit(dir_path, nursery):
+        subdirs, has_files = await trio.to_thread.run_sync(list_dir, dir_path, limiter=limiter)
+        if has_files:
+            found.append(dir_path)
+        for subdir in subdirs:
+            nursery.start_soon(visit, subdir, nursery)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(visit, root, nursery)
+    found.sort()
+    return found
+
+
+async def find_dirs(dirs, roots, hash_limiter=None, store=None, dir_filter=album_name, limiter=None):
+    """Return ({album name: DirectoryIndex}, {albumkey: DirectoryIndex}) for
+    dirs plus every directory with files under roots.
+
+    dir_filter(dir_path) gives the album name for a directory, or None to
+    skip it. Directories already synced are keyed by their albumkey.
+    """
+    dirs = list(dirs)
+    found = []
+    async def walk_root(root):
+        found.extend(await walk(root, limiter))
+    async with trio.open_nursery() as nursery:
+        for root in roots:
+            nursery.start_soon(walk_root, root)
+    dirs += sorted(found)
+
+    dir_indexes = []
+    for dir_path in dirs:
+        name = dir_filter(dir_path)
+        if name is not None:
+            dir_indexes.append(DirectoryIndex(dir_path, hash_limiter, store, name))
+    albumkeys = [None] * len(dir_indexes)
+    async def get_albumkey(i, dir_index):
+        albumkeys[i] = await dir_index.get_albumkey()
+    async with trio.open_nursery() as nursery:
+        for i, dir_index in enumerate(dir_indexes):
+            nursery.start_soon(get_albumkey, i, dir_index)
+
+    dir_by_name = {}
+    dir_by_albumkey = {}
+    for dir_index, albumkey in zip(dir_indexes, albumkeys):
+        if albumkey is None:
+            dir_by_name[dir_index.album_name] = dir_index
+        elif albumkey in dir_by_albumkey:
+            raise Exception('duplicate album key', albumkey)
+        else:
+            dir_by_albumkey[albumkey] = dir_index
+    return dir_by_name, dir_by_albumkey
@@ -0,0 +1,25 @@
+import hashlib
+
+import trio
+
+
+# hashlib releases the GIL for buffers larger than 2 KiB, so large chunks let
+# several hashing threads make progress at once.
+CHUNK_SIZE = 1 << 20
+
+
+def md5_file(path, chunk_size=CHUNK_SIZE):
+    """Hex MD5 of the file at path, read in chunk_size pieces."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+async def md5_path(path, limiter=None):
+    """Hash path in a worker thread so the event loop is not blocked."""
+    return await trio.to_thread.run_sync(md5_file, str(path), limiter=limiter)
@@ -0,0 +1,144 @@
+# Minimal HTTP/1.1 client for requests whose body is too large to hold in
+# memory. asks only accepts complete request bodies, so uploads go through
+# here instead and are written to the socket one chunk at a time.
+
+import gzip
+from json import loads as json_loads
+from urllib.parse import urlsplit
+
+import h11
+import trio
+
+
+RECEIVE_SIZE = 1 << 16
+
+
+class Response(object):
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json_loads(self.content)
+
+
+class Connection(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.h11 = h11.Connection(h11.CLIENT)
+
+    async def _send(self, event):
+        await self.stream.send_all(self.h11.send(event))
+
+    async def _next_event(self):
+        while True:
+            event = self.h11.next_event()
+            if event is not h11.NEED_DATA:
+                return event
+            self.h11.receive_data(await self.stream.receive_some(RECEIVE_SIZE))
+
+    async def request(self, method, target, headers, body=None):
+        await self._send(h11.Request(method=method, target=target, headers=list(headers.items())))
+        if body is not None:
+            async for chunk in body:
+                await self._send(h11.Data(data=chunk))
+        await self._send(h11.EndOfMessage())
+
+        response = await self._next_event()
+        while isinstance(response, h11.InformationalResponse):
+            response = await self._next_event()
+        if not isinstance(response, h11.Response):
+            raise Exception('Unexpected HTTP event', response)
+        content = []
+        while True:
+            event = await self._next_event()
+            if isinstance(event, h11.EndOfMessage):
+                break
+            content.append(bytes(event.data))
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                   for name, value in response.headers}
+        content = b''.join(content)
+        if headers.get('content-encoding') == 'gzip':
+            content = gzip.decompress(content)
+        return Response(response.status_code, headers, content)
+
+    async def aclose(self):
+        await self.stream.aclose()
+
+
+async def open_connection(uri):
+    parts = urlsplit(uri)
+    if parts.scheme == 'https':
+        stream = await trio.open_ssl_over_tcp_stream(parts.hostname, parts.port or 443,
+                                                     https_compatible=True)
+    else:
+        stream = await trio.open_tcp_stream(parts.hostname, parts.port or 80)
+    return Connection(stream)
+
+
+def _target_and_host(uri):
+    parts = urlsplit(uri)
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    return target, parts.netloc
+
+
+class Session(object):
+    """Pool of up to connections keep-alive connections to one host."""
+    def __init__(self, base_uri, connections=1):
+        self.base_uri = base_uri
+        self.limit = trio.CapacityLimiter(connections)
+        self.idle = []
+
+    async def _request(self, connection, method, target, headers, body):
+        response = await connection.request(method, target, headers, body)
+        if connection.h11.our_state is h11.DONE and connection.h11.their_state is h11.DONE:
+            connection.h11.start_next_cycle()
+            self.idle.append(connection)
+        else:
+            await connection.aclose()
+        return response
+
+    async def request(self, method, uri, headers=None, body=None):
+        """Same as request() but reusing connections to base_uri."""
+        target, host = _target_and_host(uri)
+        headers = {'Host': host, **(headers or {})}
+        async with self.limit:
+            while self.idle:
+                connection = self.idle.pop()
+                try:
+                    return await self._request(connection, method, target, headers, body)
+                except (trio.BrokenResourceError, h11.RemoteProtocolError):
+                    # The server probably closed the idle connection. Nothing
+                    # was processed, so try again on another one.
+                    await connection.aclose()
+                except BaseException:
+                    await connection.aclose()
+                    raise
+            connection = await open_connection(self.base_uri)
+            try:
+                return await self._request(connection, method, target, headers, body)
+            except BaseException:
+                await connection.aclose()
+                raise
+
+    async def aclose(self):
+        idle, self.idle = self.idle, []
+        for connection in idle:
+            await connection.aclose()
+
+
+async def request(method, uri, headers=None, body=None):
+    """Send a request whose body is an async iterable of bytes chunks.
+
+    headers must include Content-Length if there is a body.
+    """
+    target, host = _target_and_host(uri)
+    headers = {'Host': host, 'Connection': 'close', **(headers or {})}
+    connection = await open_connection(uri)
+    try:
+        return await connection.request(method, target, headers, body)
+    finally:
+        await connection.aclose()
@@ -1,12 +1,54 @@
-import hashlib
 import json
+import os
+import stat
 
 import trio
 
+from smog.hashing import md5_path
+from smog.trace import tracer
+
+
+INDEXED_SUFFIXES = ('.jpg', '.png', '.mp4', '.mov')
+
+
+def scan_dir(dir_path, names=None):
+    """Return [(name, size, mtime_ns)] of the files in dir_path to index.
+
+    Only stats names if given, which may no longer exist. Blocking; meant to
+    run in a thread so a whole directory costs one thread hop.
+    """
+    files = []
+    if names is None:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                # is_file() is answered from the directory listing itself
+                if os.path.splitext(entry.name)[1].lower() in INDEXED_SUFFIXES and entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime_ns))
+    else:
+        for name in names:
+            if os.path.splitext(name)[1].lower() not in INDEXED_SUFFIXES:
+                continue
+            try:
+                st = os.stat(os.path.join(dir_path, name))
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files.append((name, st.st_size, st.st_mtime_ns))
+    return files
+
 
 class DirectoryIndex(object):
-    def __init__(self, dir_path):
+    def __init__(self, dir_path, hash_limiter=None, store=None, album_name=None):
+        # hash_limiter caps hashing threads; share one across indexes to cap
+        # them globally. If store (an IndexStore) is given the index lives
+        # there instead of in .smog/index. album_name is the name for the
+        # album the directory syncs to, by default the directory's name.
         self.dir_path = trio.Path(dir_path)
+        self.album_name = album_name or self.dir_path.name
+        self.hash_limiter = hash_limiter
+        self.store = store
+        self.store_key = os.path.abspath(dir_path)
         self.index_path = self.dir_path / '.smog' / 'index'
         self.albumkey_path = self.dir_path / '.smog' / 'albumkey'
         self.cache = None
@@ -22,30 +64,65 @@ class DirectoryIndex(object):
 
     async def _load_cache(self):
         self.cache = {}
+        if self.store is not None:
+            self.cache = await self.store.load_files(self.store_key)
+            if self.cache:
+                return
+        # Also used to seed an empty store so nothing is rehashed
         if await self.index_path.exists():
-            async with await self.index_path.open() as index_file:
-                async for line in index_file:
-                    md5, size, mtime, filename = line.rstrip('\n').split(' ', 3)
-                    self.cache[(size, mtime, filename)] = md5
+            for line in (await self.index_path.read_text()).splitlines():
+                md5, size, mtime, filename = line.split(' ', 3)
+                self.cache[(int(size), int(mtime), filename)] = md5
+
+    async def _hash(self, entry, md5s):
+        md5s[entry.name] = await md5_path(entry, limiter=self.hash_limiter)
+
+    async def _scan(self, names=None):
+        with tracer.span('index', 'scan', dir=self.store_key) as fields:
+            files = await trio.to_thread.run_sync(scan_dir, str(self.dir_path), names)
+            fields['files'] = len(files)
+        return files
+
+    async def _index(self, files):
+        """Hash what the cache misses and save files as the index."""
+        md5s = {}
+        with tracer.span('index', 'hash', dir=self.store_key) as fields:
+            fields['files'] = 0
+            async with trio.open_nursery() as nursery:
+                for name, size, mtime in files:
+                    md5 = self.cache.get((size, mtime, name))
+                    if md5 is None:
+                        fields['files'] += 1
+                        nursery.start_soon(self._hash, self.dir_path / name, md5s)
+                    else:
+                        md5s[name] = md5
+        tracer.count('md5 cache hits', len(files) - fields['files'])
+        tracer.count('md5 cache misses', fields['files'])
+        if self.store is not None:
+            await self.store.update_files(self.store_key,
+                                          [(name, size, mtime, md5s[name]) for name, size, mtime in files])
+        else:
+            await self.index_path.parent.mkdir(exist_ok=True)
+            await self.index_path.write_text(''.join(f'{md5s[name]} {size} {mtime} {name}\n'
+                                                     for name, size, mtime in files))
+        self.cache = {(size, mtime, name): md5s[name] for name, size, mtime in files}
 
     async def reindex(self):
         if self.cache is None:
             await self._load_cache()
-        entries = list(await self.dir_path.iterdir())
-        entries.sort()
-        await self.index_path.parent.mkdir(exist_ok=True)
-        async with await self.index_path.open('w') as index_file:
-            for entry in entries:
-                if not await entry.is_file() or entry.suffix.lower() not in ('.jpg', '.png', '.mp4', '.mov'):
-                    continue
-                stat = await entry.stat()
-                size = stat.st_size
-                mtime = stat.st_mtime_ns
-                md5 = self.cache.get((size, mtime, entry.name))
-                if md5 is None:
-                    md5 = hashlib.md5(await entry.read_bytes()).hexdigest()
-                await index_file.write(f'{md5} {size} {mtime} {entry.name}\n')
-        await self._load_cache()
+        files = await self._scan()
+        files.sort()
+        await self._index(files)
+
+    async def update(self, names):
+        """Reindex only the files called names, which may no longer exist."""
+        if self.cache is None:
+            await self._load_cache()
+        names = set(names)
+        files = [(filename, size, mtime) for size, mtime, filename in self.cache if filename not in names]
+        files += await self._scan(names)
+        files.sort()
+        await self._index(files)
 
     async def iter_by_md5(self):
         if self.cache is None:
@@ -67,34 +144,165 @@ class DirectoryIndex(object):
             yield x
 
 
+def is_removed(image):
+    """Whether an AlbumImage was marked for removal by smog."""
+    return 'smog.removed' in [k.strip() for k in (image.get('Keywords') or '').split(';')]
+
+
+# All AlbumIndex needs of each AlbumImage
+ALBUM_IMAGE_FIELDS = ('ArchivedMD5', 'Uri', 'Keywords')
+
+
+def _md5_bytes(md5):
+    try:
+        md5_bytes = bytes.fromhex(md5 or '')
+    except ValueError:
+        md5_bytes = b''
+    # An image without a usable md5 never matches a file, as before
+    return md5_bytes if len(md5_bytes) == 16 else bytes(16)
+
+
+class AlbumImages(object):
+    """An album's sorted (md5, image URI) pairs, iterated like a list of
+    tuples but kept as one string of 16 byte md5s and one of image keys.
+
+    Keys are URIs relative to prefix, the album's endpoint + '/image/',
+    or whole URIs for the odd one that is not under it.
+    """
+    def __init__(self, prefix, md5s=b'', keys=b''):
+        self.prefix = prefix
+        self.md5s = md5s
+        self.keys = keys
+
+    @classmethod
+    def from_pairs(cls, prefix, pairs):
+        pairs = sorted((_md5_bytes(md5), uri[len(prefix):] if uri.startswith(prefix) else uri)
+                       for md5, uri in pairs)
+        return cls(prefix, b''.join(md5 for md5, _ in pairs), '\n'.join(key for _, key in pairs).encode())
+
+    def __len__(self):
+        return len(self.md5s) // 16
+
+    def __iter__(self):
+        start = 0
+        for i in range(len(self)):
+            end = self.keys.find(b'\n', start)
+            if end < 0:
+                end = len(self.keys)
+            key = self.keys[start:end].decode()
+            start = end + 1
+            yield self.md5s[i * 16:i * 16 + 16].hex(), key if key.startswith('/') else self.prefix + key
+
+
 class AlbumIndex(object):
-    def __init__(self, index_path, api, album_endpoint):
+    """An album's images by md5, cached at index_path.
+
+    The file is a JSON header line ({"LastUpdated", "Count"}) followed by
+    the AlbumImages columns: Count 16 byte md5s, Count removed flags, then
+    the image keys separated by newlines.
+    """
+    def __init__(self, index_path, api, album_endpoint, last_updated=None, store=None):
+        # last_updated is the album's modification timestamp from its node
+        # listing. If it matches the cached index, reindex skips the API.
+        # If store (an IndexStore) is given the index lives there instead of
+        # at index_path.
         self.index_path = trio.Path(index_path)
         self.api = api
         self.album_endpoint = album_endpoint
+        self.albumkey = album_endpoint.split('/')[-1]
+        self.last_updated = last_updated
+        self.store = store
+        # Loaded by iter_by_md5 or load_cached
         self.by_md5 = None
+        # URIs of images marked for removal, which are still in by_md5
+        self.removed = set()
+
+    def _dump(self, images):
+        removed = bytes(uri in self.removed for _, uri in images)
+        header = json.dumps({'LastUpdated': self.last_updated, 'Count': len(images)}).encode()
+        return b''.join((header, b'\n', images.md5s, removed, images.keys))
+
+    def _load(self, data):
+        header, _, data = data.partition(b'\n')
+        count = json.loads(header).get('Count')
+        if count is None:
+            # An index from before the compact format
+            self.by_md5 = AlbumImages(self.album_endpoint + '/image/')
+            self.removed = set()
+            return
+        self.by_md5 = AlbumImages(self.album_endpoint + '/image/', data[:count * 16], data[count * 17:])
+        flags = data[count * 16:count * 17]
+        self.removed = {uri for flag, (_, uri) in zip(flags, self.by_md5) if flag}
 
-    def _load_json(self, json_data):
-        self.by_md5 = [(image['ArchivedMD5'], image['Uri'])
-                       for image in json_data['AlbumImage']]
-        self.by_md5.sort()
+    async def _read_header(self):
+        if not await self.index_path.exists():
+            return {}
+        async with await self.index_path.open('rb') as index_file:
+            header = await index_file.readline()
+        try:
+            return json.loads(header)
+        except ValueError:
+            return {}
 
     async def reindex(self):
-        album_images = []
-        next_page = self.album_endpoint
-        while next_page:
-            album_response = await self.api.list_images(next_page)
-            album_images += album_response['Response'].get('AlbumImage', [])
-            next_page = album_response['Response']['Pages'].get('NextPage')
-        json_data = {'AlbumImage': album_images}
-        await self.index_path.write_text(json.dumps(json_data))
-        self._load_json(json_data)
+        if self.store is not None:
+            await self._reindex_store()
+            return
+        if self.last_updated is not None:
+            header = await self._read_header()
+            if 'Count' in header and header.get('LastUpdated') == self.last_updated:
+                # Loaded when needed
+                self.by_md5 = None
+                return
+        pairs = []
+        self.removed = set()
+        async for image in self.api.iter_images(self.album_endpoint, ALBUM_IMAGE_FIELDS):
+            pairs.append((image['ArchivedMD5'], image['Uri']))
+            if is_removed(image):
+                self.removed.add(image['Uri'])
+        self.by_md5 = AlbumImages.from_pairs(self.album_endpoint + '/image/', pairs)
+        await self.index_path.write_bytes(self._dump(self.by_md5))
+
+    async def invalidate(self):
+        """Make the next reindex list the album again.
+
+        Call before changing the album. SmugMug is not known to update the
+        node's DateModified when images are added or changed, so a cached
+        listing is only trusted for albums the last run left alone.
+        """
+        self.last_updated = None
+        if self.store is not None:
+            await self.store.invalidate_album(self.albumkey)
+        elif (await self._read_header()).get('LastUpdated') is not None:
+            # Keep the listing, which load_cached may still use
+            header, _, data = (await self.index_path.read_bytes()).partition(b'\n')
+            header = {**json.loads(header), 'LastUpdated': None}
+            await self.index_path.write_bytes(json.dumps(header).encode() + b'\n' + data)
+
+    async def _reindex_store(self):
+        if (self.last_updated is not None and
+                await self.store.album_last_updated(self.albumkey) == self.last_updated):
+            self.by_md5 = await self.store.album_by_md5(self.albumkey)
+            self.removed = await self.store.album_removed(self.albumkey)
+            return
+        images = [image async for image in self.api.iter_images(self.album_endpoint, ALBUM_IMAGE_FIELDS)]
+        self.by_md5 = sorted((image['ArchivedMD5'], image['Uri']) for image in images)
+        self.removed = {image['Uri'] for image in images if is_removed(image)}
+        await self.store.update_album(self.albumkey, self.last_updated, self.by_md5, self.removed)
+
+    async def load_cached(self):
+        """Load the index left by the last reindex, if not loaded yet."""
+        if self.by_md5 is not None:
+            return
+        if self.store is not None:
+            self.by_md5 = await self.store.album_by_md5(self.albumkey)
+            self.removed = await self.store.album_removed(self.albumkey)
+        elif await self.index_path.exists():
+            self._load(await self.index_path.read_bytes())
+        else:
+            self.by_md5 = []
 
     async def iter_by_md5(self):
-        if self.by_md5 is None:
-            if await self.index_path.exists():
-                self._load_json(json.loads(await self.index_path.read_text()))
-            else:
-                self.by_md5 = []
+        await self.load_cached()
         for x in self.by_md5:
             yield x
@@ -0,0 +1,74 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+
+import trio
+try:
+    from trio.lowlevel import wait_readable
+except ImportError:
+    from trio.hazmat import wait_readable
+
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+CHANGES = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Minimal inotify(7) wrapper for trio, Linux only.
+
+    read() returns (dir_path, name) for each changed entry, or
+    (None, None) if the kernel queue overflowed and events were lost.
+    """
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+        self.paths = {}
+
+    def _raise(self):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask=CHANGES):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise()
+        self.paths[wd] = path
+
+    async def read(self):
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+                break
+            except BlockingIOError:
+                await wait_readable(self.fd)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, None))
+            elif wd in self.paths and name:
+                events.append((self.paths[wd], name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
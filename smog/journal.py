@@ -0,0 +1,96 @@
+import json
+
+import trio
+
+
+# Returned by an operation that chose not to do anything, so it is not
+# recorded as done and is tried again next run
+NOT_DONE = object()
+
+def operation_key(operation):
+    """Identify an operation (msg, fn, *args) across runs."""
+    _, fn, *args = operation
+    return [fn.__name__, *map(str, args)]
+
+
+class Journal(object):
+    """Durable log of planned and completed operations.
+
+    Each operation is recorded as planned when the diff produces it and as
+    done once it succeeds, one JSON line each, flushed immediately. A later
+    run skips operations that are already done, even if the album listing it
+    fetched does not show them yet.
+    """
+    def __init__(self, path):
+        self.path = trio.Path(path)
+        self.previous_done = set()
+        self.previous_planned = set()
+        self.done = set()
+        self.planned = set()
+        self.in_flight = set()
+        self.file = None
+
+    async def open(self):
+        if await self.path.exists():
+            async with await self.path.open() as journal_file:
+                async for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write from an interrupted run
+                        continue
+                    key = tuple(record['key'])
+                    if record['state'] == 'done':
+                        self.previous_done.add(key)
+                    else:
+                        self.previous_planned.add(key)
+        self.previous_planned -= self.previous_done
+        if self.previous_planned:
+            print(f'{len(self.previous_planned)} operations did not complete last run')
+        self.file = await self.path.open('a')
+
+    async def _record(self, state, key):
+        await self.file.write(json.dumps({'state': state, 'key': list(key)}) + '\n')
+        await self.file.flush()
+
+    async def plan(self, operation):
+        """Record operation as planned and return it wrapped to record
+        completion, or None if it was already done or is in flight."""
+        key = tuple(operation_key(operation))
+        if key in self.previous_done or key in self.done:
+            print(f'Already done: {operation[0]}')
+            return None
+        if key in self.in_flight:
+            # Watch mode diffs the same album again while this is running
+            return None
+        self.planned.add(key)
+        self.in_flight.add(key)
+        await self._record('planned', key)
+        msg, fn, *args = operation
+        return (msg, self._run, key, fn, *args)
+
+    async def _run(self, key, fn, *args):
+        try:
+            result = await fn(*args)
+        finally:
+            self.in_flight.discard(key)
+        if result is not NOT_DONE:
+            self.done.add(key)
+            await self._record('done', key)
+        return result
+
+    async def close(self, compact=True):
+        """Compact to this run's operations. Done operations from earlier
+        runs have had a full run for album listings to catch up, and ones
+        left over that this run did not plan again are no longer needed.
+
+        Pass compact=False if the run did not finish, to keep everything."""
+        await self.file.aclose()
+        if not compact:
+            return
+        outstanding = self.planned - self.done
+        lines = [json.dumps({'state': 'done', 'key': list(key)}) + '\n' for key in self.done]
+        lines += [json.dumps({'state': 'planned', 'key': list(key)}) + '\n' for key in outstanding]
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        await tmp_path.write_text(''.join(lines))
+        await tmp_path.replace(self.path)
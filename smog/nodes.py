@@ -0,0 +1,113 @@
+import json
+
+import trio
+
+
+# What is kept of each child node
+NODE_FIELDS = ('Name', 'Type', 'Uri', 'Uris', 'DateModified')
+
+
+class NodeCache(object):
+    """Folder paths and folder children from earlier runs, kept at path
+    (or only in memory if path is None).
+
+    A cached folder path is checked with one GET of its node instead of
+    listing every folder along the path. Children are listed newest first
+    and only until one is unchanged since the last run; everything after it
+    is unchanged too. That picks up new, renamed and modified albums, and the
+    total count shows whether any were deleted, in which case the folder is
+    listed in full.
+    """
+    def __init__(self, path):
+        self.path = path and trio.Path(path)
+        # folder path -> node URI
+        self.folders = {}
+        # folder node URI -> {node URI: node}
+        self.children = {}
+
+    async def load(self):
+        if self.path is None or not await self.path.exists():
+            return
+        try:
+            json_data = json.loads(await self.path.read_text())
+        except ValueError:
+            # Torn write from an interrupted run
+            return
+        self.folders = json_data['folders']
+        self.children = json_data['children']
+
+    async def save(self):
+        if self.path is None:
+            return
+        await self.path.write_text(json.dumps({'folders': self.folders, 'children': self.children}))
+
+    async def _find_folder(self, api, folder_path):
+        authuser_response = await api.get_authuser()
+        folder_node_endpoint = authuser_response['Response']['User']['Uris']['Node']
+        self.folders[''] = folder_node_endpoint
+        path = ''
+        for next_part in folder_path.split('/'):
+            if not next_part:
+                continue
+            async for node in api.iter_nodes(folder_node_endpoint):
+                if node['Name'] == next_part:
+                    folder_node_endpoint = node['Uri']
+                    break
+            else:
+                raise Exception('No folder', next_part)
+            path += next_part + '/'
+            self.folders[path] = folder_node_endpoint
+        return folder_node_endpoint
+
+    async def find_folder(self, api, folder_path):
+        """Return the node URI of the folder at folder_path, e.g. 'a/b'."""
+        parts = [part for part in folder_path.split('/') if part]
+        path = ''.join(part + '/' for part in parts)
+        folder_node_endpoint = self.folders.get(path)
+        if folder_node_endpoint is not None and parts:
+            try:
+                node = (await api.get_node(folder_node_endpoint))['Response']['Node']
+            except Exception:
+                node = None
+            # Moved folders are found again from the top
+            if node is None or node['Name'] != parts[-1]:
+                folder_node_endpoint = None
+        if folder_node_endpoint is None:
+            folder_node_endpoint = await self._find_folder(api, path)
+        return folder_node_endpoint
+
+    async def list_children(self, api, folder_node_endpoint):
+        """Return the child nodes of folder_node_endpoint."""
+        cached = self.children.get(folder_node_endpoint)
+        if cached is None:
+            nodes = [node async for node in api.iter_nodes(folder_node_endpoint)]
+        else:
+            nodes = await self._list_changed(api, folder_node_endpoint, cached)
+        self.children[folder_node_endpoint] = {
+            node['Uri']: {field: node[field] for field in NODE_FIELDS if field in node} for node in nodes}
+        return nodes
+
+    async def _list_changed(self, api, folder_node_endpoint, cached):
+        changed = {}
+        start = count = None
+        while True:
+            response = (await api.list_nodes(folder_node_endpoint, start, count, newest_first=True))['Response']
+            page = response.get('Node', [])
+            pages = response.get('Pages', {})
+            total = pages.get('Total', len(page))
+            unchanged = False
+            for node in page:
+                previous = cached.get(node['Uri'])
+                if previous is not None and previous.get('DateModified') == node.get('DateModified'):
+                    unchanged = True
+                    break
+                changed[node['Uri']] = node
+            count = pages.get('RequestedCount') or pages.get('Count')
+            start = pages.get('Start', 1) + len(page)
+            if unchanged or not page or not count or start > total:
+                break
+        nodes = list(changed.values()) + [node for uri, node in cached.items() if uri not in changed]
+        if len(nodes) != total:
+            # Something was deleted or moved away
+            nodes = [node async for node in api.iter_nodes(folder_node_endpoint)]
+        return nodes
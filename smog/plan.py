@@ -0,0 +1,100 @@
+import json
+
+import trio
+from async_generator import asynccontextmanager
+
+
+class Planner(object):
+    """Stands in for a scheduler.Scheduler, recording the operations
+    submitted to it as a plan instead of running them.
+
+    The plan is JSON: the folder albums are created in, every album being
+    synced, the operations in order and totals. Operations are
+
+        {'op': 'upload', 'album', 'path', 'md5', 'size', 'mtime'}
+        {'op': 'keywords', 'uri', 'keywords'}
+        {'op': 'create', 'name', 'dir', 'uploads': [upload, ...]}
+
+    rate (bytes per second) estimates how long the uploads take, and
+    requests_per_second the other API calls.
+    """
+    def __init__(self, metadata_limit, folder_node_endpoint, rate=None, requests_per_second=None):
+        # For reindexing while planning
+        self.metadata_limiter = trio.CapacityLimiter(metadata_limit)
+        self.progress = [0, 0]
+        self.folder_node_endpoint = folder_node_endpoint
+        self.rate = rate
+        self.requests_per_second = requests_per_second
+        self.albums = set()
+        self.operations = []
+
+    def submit(self, operation, size=None, mtime=0, group=None):
+        msg, fn, *args = operation
+        if fn.__name__ == 'upload_image':
+            album_endpoint, image_path, md5 = args
+            self.operations.append({'op': 'upload', 'album': album_endpoint, 'path': str(image_path),
+                                    'md5': md5, 'size': size, 'mtime': mtime})
+        elif fn.__name__ == 'set_keywords':
+            endpoint, keywords = args
+            self.operations.append({'op': 'keywords', 'uri': endpoint, 'keywords': keywords})
+        else:
+            raise ValueError('cannot plan', msg)
+
+    def add_album(self, album_endpoint):
+        """Note an album being synced, e.g. for duplicates when applying."""
+        self.albums.add(album_endpoint)
+
+    async def add_new_album(self, album_name, dir_index):
+        """Plan creating an album for dir_index and uploading all of it."""
+        self.progress[1] += 1
+        async with self.metadata_limiter:
+            print(f'Reindexing {dir_index.dir_path}', self.progress)
+            self.progress[0] += 1
+            await dir_index.reindex()
+        files = {filename: (size, mtime) for size, mtime, filename in dir_index.cache}
+        uploads = []
+        async for md5, filename in dir_index.iter_by_md5():
+            size, mtime = files[filename]
+            uploads.append({'path': str(dir_index.dir_path / filename), 'md5': md5, 'size': size, 'mtime': mtime})
+        self.operations.append({'op': 'create', 'name': album_name, 'dir': str(dir_index.dir_path),
+                                'uploads': uploads})
+
+    def totals(self):
+        uploads = [op for op in self.operations if op['op'] == 'upload']
+        uploads += [upload for op in self.operations if op['op'] == 'create' for upload in op['uploads']]
+        totals = {
+            'uploads': len(uploads),
+            'upload_bytes': sum(upload['size'] for upload in uploads),
+            'removals': sum(op['op'] == 'keywords' and 'smog.removed' in op['keywords']
+                            for op in self.operations),
+            'keywords': sum(op['op'] == 'keywords' for op in self.operations),
+            'albums_created': sum(op['op'] == 'create' for op in self.operations),
+            'estimated_seconds': None,
+        }
+        if self.rate:
+            seconds = totals['upload_bytes'] / self.rate
+            if self.requests_per_second:
+                seconds += (totals['keywords'] + totals['albums_created']) / self.requests_per_second
+            totals['estimated_seconds'] = seconds
+        return totals
+
+    def to_json(self):
+        return {'folder': self.folder_node_endpoint, 'albums': sorted(self.albums),
+                'operations': self.operations, 'totals': self.totals()}
+
+
+@asynccontextmanager
+async def open_planner(path, metadata_limit, folder_node_endpoint, rate=None, requests_per_second=None):
+    """Yield a Planner; on exit write its plan to path."""
+    planner = Planner(metadata_limit, folder_node_endpoint, rate, requests_per_second)
+    yield planner
+    await trio.Path(path).write_text(json.dumps(planner.to_json(), indent=1) + '\n')
+    totals = planner.totals()
+    print(f'Planned {totals["uploads"]} uploads of {totals["upload_bytes"] / 1e6:.1f} MB, '
+          f'{totals["removals"]} removals and {totals["albums_created"]} new albums')
+    if totals['estimated_seconds'] is not None:
+        print(f'Estimated {totals["estimated_seconds"]:.0f}s')
+
+
+async def read_plan(path):
+    return json.loads(await trio.Path(path).read_text())
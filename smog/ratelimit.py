@@ -0,0 +1,87 @@
+import time
+
+import trio
+
+
+class TokenBucket(object):
+    """Token bucket shared by concurrent tasks.
+
+    Refills at rate tokens per second up to capacity. The rate adapts to
+    server feedback: slow_down() halves it and speed_up() creeps back up
+    towards max_rate, so sustained throughput settles just under whatever
+    the server tolerates.
+    """
+    def __init__(self, rate, capacity=None, min_rate=None):
+        self.max_rate = self.rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = None
+        self.paused_until = 0
+        # Lock so waiters are served in FIFO order
+        self.lock = trio.Lock()
+
+    def _refill(self):
+        now = trio.current_time()
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    async def acquire(self, amount=1):
+        # amount may exceed capacity; the bucket then goes into debt and later
+        # callers wait it off.
+        async with self.lock:
+            while True:
+                now = self._refill()
+                if now < self.paused_until:
+                    await trio.sleep_until(self.paused_until)
+                    continue
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return
+                await trio.sleep((min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next seconds."""
+        self.paused_until = max(self.paused_until, trio.current_time() + seconds)
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = max(self.min_rate, min(self.max_rate, rate))
+
+    def slow_down(self):
+        self.set_rate(self.rate / 2)
+
+    def speed_up(self):
+        self.set_rate(self.rate + self.max_rate / 32)
+
+
+class Bandwidth(object):
+    """Caps bytes per second across all callers of acquire().
+
+    rate is in bytes per second, None for no cap. schedule is a list of
+    (start, end, rate) with start and end in minutes since local midnight;
+    the first period containing the current time overrides rate. A period
+    may wrap past midnight.
+    """
+    def __init__(self, rate=None, schedule=()):
+        self.rate = rate
+        self.schedule = schedule
+        self.bucket = None
+
+    def current_rate(self):
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.rate
+
+    async def acquire(self, amount):
+        rate = self.current_rate()
+        if rate is None:
+            return
+        if self.bucket is None or self.bucket.max_rate != rate:
+            self.bucket = TokenBucket(rate)
+        await self.bucket.acquire(amount)
@@ -1,34 +1,63 @@
 # Reset all album and image keywords to smog.upload.
 # Set all albums to unlisted with a password.
 
-import itertools
 import logging
 import os
 import sys
-from async_generator import asynccontextmanager
 
 import trio
 
 from smog.api import SmugMugApi
+from smog.nodes import NodeCache
 
 
-# TODO refactor pagination logic
-async def list_nodes(api, next_page):
-    while next_page:
-        nodes_response = await api.list_nodes(next_page)
-        for node in nodes_response['Response'].get('Node', []):
-            yield node
-        next_page = nodes_response['Response']['Pages'].get('NextPage')
+CONCURRENCY = 8
+KEYWORDS = 'smog.upload'
 
 
-async def reset_image_keywords(limit, api, image_endpoint):
-    async with limit:
-        print(f'Resetting keywords {image_endpoint}')
-        await api.set_keywords(image_endpoint, 'smog.upload')
+def keywords_match(image, keywords):
+    return [k.strip() for k in (image.get('Keywords') or '').split(';') if k.strip()] == \
+        [k.strip() for k in keywords.split(';')]
+
+
+async def run_patches(receive_patches, progress):
+    # Failed PATCHes are logged and skipped so the rest still run
+    async with receive_patches:
+        async for msg, fn, *args in receive_patches:
+            print(msg, progress)
+            progress[0] += 1
+            try:
+                await fn(*args)
+            except Exception:
+                logging.exception('Unhandled exception!')
+
+
+async def reset_album(api, album_endpoint):
+    await api._request_json('PATCH', album_endpoint,
+                            headers={'Content-Type': 'application/json'},
+                            json={'Privacy': 'Unlisted',
+                                  'Password': os.environ['ALBUM_PASSWORD'],
+                                  'Keywords': KEYWORDS})
+
+
+async def retag_album(api, list_limit, send_patches, progress, node):
+    album_endpoint = node['Uris']['Album']
+    async with send_patches:
+        progress[1] += 1
+        await send_patches.send((f'Resetting album {album_endpoint}', reset_album, api, album_endpoint))
+        async with list_limit:
+            async for image in api.iter_images(album_endpoint, ('Uri', 'Keywords')):
+                if keywords_match(image, KEYWORDS):
+                    continue
+                progress[1] += 1
+                await send_patches.send((f'Resetting keywords {image["Uri"]}',
+                                         api.set_keywords, image['Uri'], KEYWORDS))
 
 
 async def main():
-    _, root_folder = sys.argv
+    # python -m smog.retag <smugmug folder> [<local index directory>]
+    root_folder = sys.argv[1]
+    index_root = sys.argv[2] if len(sys.argv) > 2 else None
 
     oauth_consumer_key = os.environ['SMUGMUG_API_KEY']
     oauth_consumer_secret = os.environ['SMUGMUG_API_SECRET']
@@ -37,41 +66,33 @@ async def main():
 
     api = SmugMugApi(oauth_consumer_key, oauth_consumer_secret,
                      oauth_token, oauth_token_secret)
+    async with api.open_sessions(CONCURRENCY):
+        await retag(api, root_folder, index_root)
+
+
+async def retag(api, root_folder, index_root=None):
+    # With index_root the folder and its albums are looked up through the
+    # same node cache as sync uses
+    node_cache = NodeCache(index_root and trio.Path(index_root) / 'nodes')
+    await node_cache.load()
+    folder_node_endpoint = await node_cache.find_folder(api, root_folder)
+    nodes = await node_cache.list_children(api, folder_node_endpoint)
+    await node_cache.save()
 
-    authuser_response = await api.get_authuser()
-    folder_node_endpoint = authuser_response['Response']['User']['Uris']['Node']
-    while root_folder:
-        if not root_folder.endswith('/'):
-            root_folder += '/'
-        next_part, root_folder = root_folder.split('/', 1)
-        async for node in list_nodes(api, folder_node_endpoint):
-            if node['Name'] == next_part:
-                folder_node_endpoint = node['Uri']
-                break
-        else:
-            raise Exception('No folder', next_part)
-
-    async for node in list_nodes(api, folder_node_endpoint):
-        if node['Type'] != 'Album':
-            continue
-        albumkey = node['Uris']['Album'].split('/')[-1]
-        album_endpoint = '/api/v2/album/' + albumkey
-        print(f'Resetting album {album_endpoint}')
-        await api._request_json('PATCH', album_endpoint,
-                                headers={'Content-Type': 'application/json'},
-                                json={'Privacy': 'Unlisted',
-                                      'Password': os.environ['ALBUM_PASSWORD'],
-                                      'Keywords': 'smog.upload'})
-        # uncomment to skip retagging images
-        # continue
-        next_page = album_endpoint
-        while next_page:
-            album_response = await api.list_images(next_page)
-            async with trio.open_nursery() as nursery:
-                limit = trio.CapacityLimiter(8)
-                for image in album_response['Response'].get('AlbumImage', []):
-                    nursery.start_soon(reset_image_keywords, limit, api, image['Uri'])
-            next_page = album_response['Response']['Pages'].get('NextPage')
+    # Albums are listed a few at a time and every PATCH, for albums and
+    # images alike, goes through one pool of workers. Images that already
+    # have the keywords are skipped.
+    progress = [0, 0]
+    list_limit = trio.CapacityLimiter(CONCURRENCY)
+    send_patches, receive_patches = trio.open_memory_channel(CONCURRENCY)
+    async with trio.open_nursery() as nursery:
+        async with receive_patches:
+            for _ in range(CONCURRENCY):
+                nursery.start_soon(run_patches, receive_patches.clone(), progress)
+        async with send_patches:
+            for node in nodes:
+                if node['Type'] == 'Album':
+                    nursery.start_soon(retag_album, api, list_limit, send_patches.clone(), progress, node)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+import heapq
+import itertools
+import logging
+
+import trio
+from async_generator import asynccontextmanager
+
+
+ORDERS = ('fifo', 'smallest', 'newest', 'fair')
+
+
+class Scheduler(object):
+    """Runs operations (msg, fn, *args) in two lanes.
+
+    Metadata operations (anything submitted without a size) run up to
+    metadata_limit at a time in the order submitted, so they are never stuck
+    behind uploads. Uploads run up to upload_limit at a time and only while
+    their sizes add up to at most upload_bytes, except that one upload always
+    runs even if it alone is bigger. Waiting uploads start in the given order:
+    'fifo', 'smallest' first, 'newest' (by mtime) first, or 'fair', which
+    takes one from each group (album) in turn.
+
+    Uploads are counted in throughput (a throughput.Throughput) if given.
+    """
+    def __init__(self, metadata_limit, upload_limit, upload_bytes, order='fifo', throughput=None):
+        self.metadata_limiter = trio.CapacityLimiter(metadata_limit)
+        self.upload_limit = upload_limit
+        self.upload_bytes = upload_bytes
+        self.order = order
+        self.throughput = throughput
+        self.uploads = []
+        self.uploading = 0
+        self.uploading_bytes = 0
+        self.seq = itertools.count()
+        self.group_seq = {}
+        self.changed = trio.Event()
+        self.closed = False
+        self.nursery = None
+        # [done, total]
+        self.progress = [0, 0]
+
+    def _priority(self, size, mtime, group):
+        if self.order == 'smallest':
+            return (size,)
+        if self.order == 'newest':
+            return (-mtime,)
+        if self.order == 'fair':
+            group_seq = self.group_seq.setdefault(group, itertools.count())
+            return (next(group_seq),)
+        return ()
+
+    def _wake(self):
+        self.changed.set()
+        self.changed = trio.Event()
+
+    def submit(self, operation, size=None, mtime=0, group=None):
+        """Queue operation; pass size (bytes) to run it in the upload lane."""
+        self.progress[1] += 1
+        if size is None:
+            self.nursery.start_soon(self._run_metadata, operation)
+            return
+        if self.throughput is not None:
+            self.throughput.plan(group, size)
+        heapq.heappush(self.uploads, (*self._priority(size, mtime, group), next(self.seq), size, group, operation))
+        self._wake()
+
+    async def _run(self, msg, fn, *args, upload=False):
+        if upload and self.throughput is not None:
+            print(msg, self.progress, self.throughput.summary())
+        else:
+            print(msg, self.progress)
+        self.progress[0] += 1
+        await fn(*args)
+
+    async def _run_and_log_errors(self, operation, upload=False):
+        # Failed operations are logged and skipped so the rest still run
+        try:
+            await self._run(*operation, upload=upload)
+        except Exception:
+            logging.exception('Unhandled exception!')
+
+    async def _run_metadata(self, operation):
+        async with self.metadata_limiter:
+            await self._run_and_log_errors(operation)
+
+    async def _run_upload(self, size, group, operation):
+        try:
+            await self._run_and_log_errors(operation, upload=True)
+        finally:
+            self.uploading -= 1
+            self.uploading_bytes -= size
+            if self.throughput is not None:
+                self.throughput.finish(group, size)
+            self._wake()
+
+    async def _dispatch_uploads(self):
+        while self.uploads or not self.closed:
+            if self.uploads and self.uploading < self.upload_limit:
+                *_, size, group, operation = self.uploads[0]
+                if not self.uploading or self.uploading_bytes + size <= self.upload_bytes:
+                    heapq.heappop(self.uploads)
+                    self.uploading += 1
+                    self.uploading_bytes += size
+                    self.nursery.start_soon(self._run_upload, size, group, operation)
+                    continue
+            await self.changed.wait()
+
+
+@asynccontextmanager
+async def open_scheduler(metadata_limit, upload_limit, upload_bytes, order='fifo', throughput=None):
+    """Yield a Scheduler; on exit wait for everything submitted to finish."""
+    scheduler = Scheduler(metadata_limit, upload_limit, upload_bytes, order, throughput)
+    async with trio.open_nursery() as nursery:
+        scheduler.nursery = nursery
+        nursery.start_soon(scheduler._dispatch_uploads)
+        try:
+            yield scheduler
+        finally:
+            scheduler.closed = True
+            scheduler._wake()
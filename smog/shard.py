@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+
+import trio
+
+from smog.throughput import Throughput
+
+
+# Seconds between merged progress lines
+PROGRESS_INTERVAL = 10
+
+
+def shard_of(key, shards):
+    """Which of shards processes syncs the album with key (its albumkey,
+    or its name if it is still to be created). Stable across processes."""
+    return int(hashlib.md5(key.encode()).hexdigest(), 16) % shards
+
+
+def in_shard(shard, key):
+    """Whether key belongs to shard, an (index, count) pair or None for all."""
+    return shard is None or shard_of(key, shard[1]) == shard[0]
+
+
+async def write_results(path, progress, throughput):
+    """Write what a shard did to path for the coordinator to merge."""
+    await trio.Path(path).write_text(json.dumps({
+        'progress': progress,
+        'planned': throughput.planned,
+        'finished': throughput.finished,
+        'sent': throughput.sent_bytes,
+    }))
+
+
+class Coordinator(object):
+    """Runs one smog process per shard with the same arguments plus
+    --shard I/N and relays their output, prefixed with the shard.
+
+    Every album goes to exactly one shard (see shard_of), so shards never
+    touch the same album, directory or album index. Each splits the request
+    and bandwidth limits and hash workers evenly, keeping the totals within
+    what was asked for.
+    """
+    def __init__(self, argv, shards, results_dir):
+        self.argv = argv
+        self.shards = shards
+        self.results_dir = trio.Path(results_dir)
+        # shard -> [done, total] from its latest progress line
+        self.progress = {}
+        self.failed = []
+
+    def _results_path(self, shard):
+        return self.results_dir / f'shard-{shard}.json'
+
+    async def _relay(self, shard, stream):
+        buffered = b''
+        async for data in stream:
+            buffered += data
+            *lines, buffered = buffered.split(b'\n')
+            for line in lines:
+                line = line.decode(errors='replace')
+                match = re.search(r'\[(\d+), (\d+)\]', line)
+                if match:
+                    self.progress[shard] = [int(match.group(1)), int(match.group(2))]
+                print(f'[{shard}/{self.shards}] {line}')
+        if buffered:
+            print(f'[{shard}/{self.shards}] {buffered.decode(errors="replace")}')
+
+    async def _run_shard(self, shard):
+        command = [sys.executable, '-m', 'smog', *self.argv, '--shard', f'{shard}/{self.shards}',
+                   '--shard-results', str(self._results_path(shard))]
+        # Unbuffered so progress arrives as it happens
+        env = {**os.environ, 'PYTHONUNBUFFERED': '1'}
+        process = await trio.open_process(command, stdout=subprocess.PIPE, env=env)
+        try:
+            await self._relay(shard, process.stdout)
+            if await process.wait():
+                self.failed.append(shard)
+        finally:
+            if process.returncode is None:
+                process.kill()
+
+    async def _print_progress(self):
+        while True:
+            await trio.sleep(PROGRESS_INTERVAL)
+            done = sum(done for done, _ in self.progress.values())
+            total = sum(total for _, total in self.progress.values())
+            print(f'All shards: {done} of {total} operations, {len(self.progress)} of {self.shards} shards started')
+
+    async def run(self):
+        """Run every shard to the end and return the merged Throughput."""
+        for shard in range(self.shards):
+            if await self._results_path(shard).exists():
+                await self._results_path(shard).unlink()
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self._print_progress)
+            async with trio.open_nursery() as shards:
+                for shard in range(self.shards):
+                    shards.start_soon(self._run_shard, shard)
+            nursery.cancel_scope.cancel()
+
+        throughput = Throughput()
+        for shard in range(self.shards):
+            if not await self._results_path(shard).exists():
+                continue
+            results = json.loads(await self._results_path(shard).read_text())
+            throughput.planned.update(results['planned'])
+            throughput.finished.update(results['finished'])
+            throughput.sent_bytes.update(results['sent'])
+        return throughput
@@ -0,0 +1,146 @@
+import sqlite3
+
+import trio
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    dir TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    PRIMARY KEY (dir, filename)
+);
+CREATE INDEX IF NOT EXISTS files_md5 ON files (md5);
+CREATE TABLE IF NOT EXISTS albums (
+    albumkey TEXT PRIMARY KEY,
+    last_updated TEXT
+);
+CREATE TABLE IF NOT EXISTS album_images (
+    albumkey TEXT NOT NULL,
+    md5 TEXT NOT NULL,
+    uri TEXT NOT NULL,
+    removed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (albumkey, uri)
+);
+CREATE INDEX IF NOT EXISTS album_images_md5 ON album_images (md5);
+'''
+
+
+class IndexStore(object):
+    """SQLite database of every directory and album index.
+
+    An alternative to the per-directory .smog/index files and per-album JSON.
+    Updates only touch changed rows, and diffs are set queries. Queries run
+    one at a time in a worker thread.
+    """
+    def __init__(self, db_path):
+        # Shard processes (--shards) take turns writing
+        self.db = sqlite3.connect(str(db_path), timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.limiter = trio.CapacityLimiter(1)
+
+    async def _run(self, fn, *args):
+        return await trio.to_thread.run_sync(fn, *args, limiter=self.limiter)
+
+    async def close(self):
+        await self._run(self.db.close)
+
+    def _load_files(self, dir_key):
+        return {(size, mtime, filename): md5 for filename, size, mtime, md5 in self.db.execute(
+            'SELECT filename, size, mtime_ns, md5 FROM files WHERE dir = ?', (dir_key,))}
+
+    async def load_files(self, dir_key):
+        """Return {(size, mtime_ns, filename): md5} for a directory."""
+        return await self._run(self._load_files, dir_key)
+
+    def _update_files(self, dir_key, files):
+        old = {filename: (size, mtime, md5) for (size, mtime, filename), md5 in self._load_files(dir_key).items()}
+        new = {filename: (size, mtime, md5) for filename, size, mtime, md5 in files}
+        with self.db:
+            self.db.executemany('DELETE FROM files WHERE dir = ? AND filename = ?',
+                                [(dir_key, filename) for filename in old.keys() - new.keys()])
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                [(dir_key, filename, *row) for filename, row in new.items()
+                                 if old.get(filename) != row])
+
+    async def update_files(self, dir_key, files):
+        """Replace a directory's rows with files [(filename, size, mtime_ns, md5)]."""
+        await self._run(self._update_files, dir_key, files)
+
+    def _album_last_updated(self, albumkey):
+        row = self.db.execute('SELECT last_updated FROM albums WHERE albumkey = ?', (albumkey,)).fetchone()
+        return row[0] if row else None
+
+    async def album_last_updated(self, albumkey):
+        return await self._run(self._album_last_updated, albumkey)
+
+    def _invalidate_album(self, albumkey):
+        with self.db:
+            self.db.execute('UPDATE albums SET last_updated = NULL WHERE albumkey = ?', (albumkey,))
+
+    async def invalidate_album(self, albumkey):
+        """Forget an album's last_updated so it is listed again."""
+        await self._run(self._invalidate_album, albumkey)
+
+    def _album_by_md5(self, albumkey):
+        return self.db.execute('SELECT md5, uri FROM album_images WHERE albumkey = ? ORDER BY md5, uri',
+                               (albumkey,)).fetchall()
+
+    async def album_by_md5(self, albumkey):
+        """Return [(md5, uri)] sorted for an album."""
+        return await self._run(self._album_by_md5, albumkey)
+
+    def _album_removed(self, albumkey):
+        return {uri for uri, in self.db.execute(
+            'SELECT uri FROM album_images WHERE albumkey = ? AND removed', (albumkey,))}
+
+    async def album_removed(self, albumkey):
+        """Return the URIs of an album's images marked for removal."""
+        return await self._run(self._album_removed, albumkey)
+
+    def _update_album(self, albumkey, last_updated, images, removed):
+        old = {(md5, uri, bool(flag)) for md5, uri, flag in self.db.execute(
+            'SELECT md5, uri, removed FROM album_images WHERE albumkey = ?', (albumkey,))}
+        new = {(md5, uri, uri in removed) for md5, uri in images}
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO albums VALUES (?, ?)', (albumkey, last_updated))
+            self.db.executemany('DELETE FROM album_images WHERE albumkey = ? AND md5 = ? AND uri = ?',
+                                [(albumkey, md5, uri) for md5, uri, _ in old - new])
+            self.db.executemany('INSERT OR REPLACE INTO album_images VALUES (?, ?, ?, ?)',
+                                [(albumkey, md5, uri, flag) for md5, uri, flag in new - old])
+
+    async def update_album(self, albumkey, last_updated, images, removed=()):
+        """Replace an album's rows with images [(md5, uri)], of which the
+        URIs in removed are marked for removal."""
+        await self._run(self._update_album, albumkey, last_updated, images, set(removed))
+
+    def _find_images(self, md5):
+        return self.db.execute('SELECT albumkey, uri FROM album_images WHERE md5 = ? AND NOT removed',
+                               (md5,)).fetchall()
+
+    async def find_images(self, md5):
+        """Return [(albumkey, uri)] of album images with md5 that are not
+        marked for removal."""
+        return await self._run(self._find_images, md5)
+
+    def _diff(self, dir_key, albumkey):
+        uploads = self.db.execute(
+            'SELECT md5, filename FROM files WHERE dir = ? AND md5 NOT IN '
+            '(SELECT md5 FROM album_images WHERE albumkey = ?) '
+            'ORDER BY md5, length(filename), filename', (dir_key, albumkey)).fetchall()
+        removals = self.db.execute(
+            'SELECT md5, uri FROM album_images WHERE albumkey = ? AND NOT removed AND md5 NOT IN '
+            '(SELECT md5 FROM files WHERE dir = ?) ORDER BY md5, uri', (albumkey, dir_key)).fetchall()
+        return uploads, removals
+
+    async def diff(self, dir_key, albumkey):
+        """Return ([(md5, filename)] to upload, [(md5, uri)] to mark for
+        removal).
+
+        Uploads may contain several files with the same md5, shortest name
+        first.
+        """
+        return await self._run(self._diff, dir_key, albumkey)
@@ -0,0 +1,66 @@
+import collections
+import datetime
+
+import trio
+
+
+class Throughput(object):
+    """Upload bytes per album and overall, with the recent rate and an ETA.
+
+    plan() and finish() take each upload's file size when it is queued and
+    when it is over (sent, skipped or failed); sent() takes bytes as they
+    actually go out, including resends.
+    """
+    WINDOW = 10
+
+    def __init__(self):
+        self.planned = collections.Counter()
+        self.finished = collections.Counter()
+        self.sent_bytes = collections.Counter()
+        # (trio.current_time(), bytes) over the last WINDOW seconds
+        self.samples = collections.deque()
+        self.started = None
+
+    def plan(self, album, size):
+        if self.started is None:
+            self.started = trio.current_time()
+        self.planned[album] += size
+
+    def finish(self, album, size):
+        self.finished[album] += size
+
+    def sent(self, album, size):
+        now = trio.current_time()
+        if self.started is None:
+            self.started = now
+        self.sent_bytes[album] += size
+        self.samples.append((now, size))
+        while self.samples[0][0] < now - self.WINDOW:
+            self.samples.popleft()
+
+    def rate(self):
+        """Bytes per second over the last WINDOW seconds."""
+        if self.started is None:
+            return 0
+        now = trio.current_time()
+        recent = sum(size for t, size in self.samples if t >= now - self.WINDOW)
+        return recent / max(min(self.WINDOW, now - self.started), 1e-3)
+
+    def eta(self):
+        """Seconds until every planned upload is over, or None if unknown."""
+        remaining = sum(self.planned.values()) - sum(self.finished.values())
+        rate = self.rate()
+        if not rate:
+            return None
+        return max(remaining, 0) / rate
+
+    def summary(self):
+        eta = self.eta()
+        eta = 'unknown' if eta is None else str(datetime.timedelta(seconds=round(eta)))
+        return (f'{sum(self.finished.values()) / 1e6:.1f} of {sum(self.planned.values()) / 1e6:.1f} MB, '
+                f'{self.rate() / 1e6:.2f} MB/s, ETA {eta}')
+
+    def album_totals(self):
+        """Yield (album, MB sent, MB planned) for every album with uploads."""
+        for album in sorted(self.planned.keys() | self.sent_bytes.keys()):
+            yield album, self.sent_bytes[album] / 1e6, self.planned[album] / 1e6
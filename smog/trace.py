@@ -0,0 +1,91 @@
+import collections
+import contextlib
+import json
+import time
+
+import trio
+try:
+    from trio.lowlevel import add_instrument
+except ImportError:
+    from trio.hazmat import add_instrument
+
+
+class Tracer(object):
+    """Timings and counters from a run.
+
+    Every event is aggregated for summary() and, after open(path), also
+    written to path as a JSON line. Use the module's tracer.
+    """
+    def __init__(self):
+        self.file = None
+        # (kind, name) -> [count, total seconds, longest seconds]
+        self.stats = {}
+        self.counters = collections.Counter()
+
+    def open(self, path):
+        self.file = open(path, 'w')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def event(self, kind, name, seconds=0, **fields):
+        stat = self.stats.setdefault((kind, name), [0, 0, 0])
+        stat[0] += 1
+        stat[1] += seconds
+        stat[2] = max(stat[2], seconds)
+        if self.file is not None:
+            self.file.write(json.dumps({'time': time.time(), 'kind': kind, 'name': name,
+                                        'seconds': seconds, **fields}) + '\n')
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    @contextlib.contextmanager
+    def span(self, kind, name, **fields):
+        """Time the with block as an event. Yields fields, which the block
+        may add to."""
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.event(kind, name, time.perf_counter() - start, **fields)
+
+    def summary(self):
+        """Return the summary as lines of text."""
+        lines = []
+        for (kind, name), (count, total, longest) in sorted(self.stats.items()):
+            lines.append(f'{kind:9} {name:40} {count:7} x {total / count:8.3f}s mean '
+                         f'{longest:8.3f}s max {total:9.3f}s total')
+        hits = self.counters['md5 cache hits']
+        misses = self.counters['md5 cache misses']
+        if hits + misses:
+            lines.append(f'md5 cache hit ratio {hits / (hits + misses):.1%} ({hits} of {hits + misses})')
+        for name, amount in sorted(self.counters.items()):
+            lines.append(f'{name} {amount}')
+        return lines
+
+
+tracer = Tracer()
+
+
+class BlockingInstrument(trio.abc.Instrument):
+    """Trace task steps that keep the event loop busy for over threshold
+    seconds, e.g. CPU work that should be in a thread."""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.started = None
+
+    def before_task_step(self, task):
+        self.started = time.perf_counter()
+
+    def after_task_step(self, task):
+        seconds = time.perf_counter() - self.started
+        if seconds > self.threshold:
+            tracer.event('blocking', task.name, seconds)
+
+
+def report_blocking(threshold):
+    """Start tracing event loop blocking; call from inside trio.run."""
+    add_instrument(BlockingInstrument(threshold))
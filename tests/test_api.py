@@ -1,9 +1,11 @@
+import random
 import unittest.mock
 
 import asks
 import pytest
 import trio.testing
 
+from smog import http
 from smog.api import SmugMugApi
 
 
@@ -16,6 +18,8 @@ class MockRequest(object):
         self.args = None
         self.kwargs = None
         self.status_code = code
+        self.headers = {}
+        self.content = b''
 
     async def __call__(self, *args, **kwargs):
         assert self.args is None
@@ -32,10 +36,18 @@ class MockRequest(object):
         return {}
 
 
+class MockUploadRequest(MockRequest):
+    async def __call__(self, *args, **kwargs):
+        # Drain the streamed body so it can be compared as bytes
+        kwargs['body'] = b''.join([chunk async for chunk in kwargs['body']])
+        return await super().__call__(*args, **kwargs)
+
+
 @trio.testing.trio_test
-async def test_api(monkeypatch):
+async def test_api(monkeypatch, tmp_path):
     request = MockRequest()
     monkeypatch.setattr(asks, 'request', request)
+    monkeypatch.setenv('ALBUM_PASSWORD', 'password')
     api = SmugMugApi('consumer key', 'consumer secret', 'token', 'token secret',
                      nonce='172302863994516684631577132899', timestamp='1577132899')
 
@@ -50,16 +62,18 @@ async def test_api(monkeypatch):
     assert await api.create_album_node('/api/v2/node/node0', 'name') == {}
     request.assert_called_once_with('POST', 'https://api.smugmug.com/api/v2/node/node0!children?_verbosity=1',
                                     headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip',
-                                             'Authorization': AUTH_PREFIX + '"Rp1IreISDFYqb8aPYz5umbe4Y9M%3D"',
+                                             'Authorization': AUTH_PREFIX + '"Xsschw%2FfGzDiRCrwqz8o9tYRSUo%3D"',
                                              'Content-Type': 'application/x-www-form-urlencoded'},
-                                    data={'Type': 'Album', 'Name': 'name', 'Privacy': 'Private', 'Keywords': 'smog.upload'})
+                                    data={'Type': 'Album', 'Name': 'name', 'Privacy': 'Unlisted',
+                                          'Password': 'password', 'Keywords': 'smog.upload'})
 
     request.reset()
-    async def read_bytes(self):
-        return b'bytes'
-    monkeypatch.setattr(trio.Path, 'read_bytes', read_bytes)
-    assert await api.upload_image('/api/v2/album/album0', 'my/image.jpg') == {}
-    request.assert_called_once_with('POST', 'https://upload.smugmug.com/',
+    upload_request = MockUploadRequest()
+    monkeypatch.setattr(http, 'request', upload_request)
+    image_path = tmp_path / 'image.jpg'
+    image_path.write_bytes(b'bytes')
+    assert await api.upload_image('/api/v2/album/album0', image_path) == {}
+    upload_request.assert_called_once_with('POST', 'https://upload.smugmug.com/',
                                     headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip',
                                              'Authorization': AUTH_PREFIX + '"VpRi1%2Bg0W7ew2UlHYN0yLdPay30%3D"',
                                              'Content-Length': '5',
@@ -70,4 +84,76 @@ async def test_api(monkeypatch):
                                              'X-Smug-Keywords': 'smog.upload',
                                              'X-Smug-ResponseType': 'JSON',
                                              'X-Smug-Version': 'v2'},
-                                    data=b'bytes')
+                                    body=b'bytes')
+
+    upload_request.reset()
+    assert await api.upload_image('/api/v2/album/album0', image_path, md5='0123456789abcdef') == {}
+    assert upload_request.kwargs['headers']['Content-MD5'] == '0123456789abcdef'
+
+
+class MockResponses(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    async def __call__(self, *args, **kwargs):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def mock_response(code, headers=None):
+    response = MockRequest()
+    response.reset(code)
+    response.headers = headers or {}
+    response.content = b''
+    return response
+
+
+@trio.testing.trio_test
+async def test_api_retries(monkeypatch):
+    monkeypatch.setattr(random, 'uniform', lambda a, b: 0)
+    api = SmugMugApi('consumer key', 'consumer secret', 'token', 'token secret')
+
+    request = MockResponses(mock_response(503), OSError('connection reset'), mock_response(200))
+    monkeypatch.setattr(asks, 'request', request)
+    assert await api.get_authuser() == {}
+    assert request.calls == 3
+
+    # POST is only retried when the server refused it with 429
+    request = MockResponses(mock_response(429, {'Retry-After': '0'}), mock_response(503))
+    monkeypatch.setattr(asks, 'request', request)
+    monkeypatch.setenv('ALBUM_PASSWORD', 'password')
+    with pytest.raises(Exception, match='HTTP error'):
+        await api.create_album_node('/api/v2/node/node0', 'name')
+    assert request.calls == 2
+
+    request = MockResponses(*[mock_response(500)] * (api.MAX_RETRIES + 1))
+    monkeypatch.setattr(asks, 'request', request)
+    with pytest.raises(Exception, match='HTTP error'):
+        await api.get_authuser()
+    assert request.calls == api.MAX_RETRIES + 1
+
+    # A malformed rate limit header doesn't fail a successful request
+    request = MockResponses(mock_response(200, {'x-ratelimit-remaining': 'lots', 'x-ratelimit-reset': '1'}))
+    monkeypatch.setattr(asks, 'request', request)
+    assert await api.get_authuser() == {}
+
+
+@trio.testing.trio_test
+async def test_api_iter_pages():
+    api = SmugMugApi('consumer key', 'consumer secret', 'token', 'token secret')
+    requests = []
+    async def list_nodes(endpoint, start=None, count=None):
+        requests.append((endpoint, start, count))
+        start = start or 1
+        count = count or 2
+        nodes = [{'Name': str(i)} for i in range(start, min(start + count, 22))]
+        return {'Response': {'Node': nodes,
+                             'Pages': {'Total': 21, 'Start': start, 'Count': len(nodes), 'RequestedCount': count}}}
+    api.list_nodes = list_nodes
+    assert [node['Name'] async for node in api.iter_nodes('/api/v2/node/node0')] == [str(i) for i in range(1, 22)]
+    assert sorted(requests, key=lambda x: x[1] or 0) == \
+        [('/api/v2/node/node0', None, None)] + [('/api/v2/node/node0', start, 2) for start in range(3, 22, 2)]
@@ -0,0 +1,43 @@
+import trio
+import trio.testing
+
+from smog.dedupe import DuplicateUploader
+from smog.index import AlbumIndex
+
+
+class MockApi(object):
+    def __init__(self):
+        self.uploads = []
+        self.collected = []
+
+    async def upload_image(self, album_endpoint, image_path, md5):
+        self.uploads.append((album_endpoint, image_path))
+        await trio.sleep(0.01)
+        return {'Image': {'AlbumImageUri': f'{album_endpoint}/image/{md5}-0'}}
+
+    async def collect_images(self, album_endpoint, image_uris):
+        self.collected.append((album_endpoint, image_uris))
+
+
+@trio.testing.trio_test
+async def test_duplicate_uploader():
+    api = MockApi()
+    uploader = DuplicateUploader(api, 'collect')
+    album_index = AlbumIndex('album0', api, '/api/v2/album/album0')
+    album_index.by_md5 = [('aa', '/api/v2/album/album0/image/aa-0'), ('cc', '/api/v2/album/album0/image/cc-0')]
+    album_index.removed = {'/api/v2/album/album0/image/cc-0'}
+    await uploader.add_album(album_index)
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(uploader.upload_image, '/api/v2/album/album1', 'a.jpg', 'aa')
+        nursery.start_soon(uploader.upload_image, '/api/v2/album/album1', 'b.jpg', 'bb')
+        nursery.start_soon(uploader.upload_image, '/api/v2/album/album2', 'b.jpg', 'bb')
+        # cc is marked for removal in album0, so it is not collected from there
+        nursery.start_soon(uploader.upload_image, '/api/v2/album/album1', 'c.jpg', 'cc')
+    # bb is uploaded to one album and collected into the other
+    assert len(api.uploads) == 2
+    assert ('/api/v2/album/album1', 'c.jpg') in api.uploads
+    uploaded_album, _ = next(upload for upload in api.uploads if upload[1] == 'b.jpg')
+    other_album = {'/api/v2/album/album1', '/api/v2/album/album2'} - {uploaded_album}
+    assert sorted(api.collected) == sorted([('/api/v2/album/album1', ['/api/v2/image/aa-0']),
+                                            (other_album.pop(), ['/api/v2/image/bb-0'])])
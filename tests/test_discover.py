@@ -0,0 +1,35 @@
+import trio
+import trio.testing
+
+from smog.discover import album_name, find_dirs
+
+
+def test_album_name():
+    assert album_name('/photos/2019 Hawaii') == '2019 Hawaii'
+    assert album_name('/photos/2019 Hawaii/darktable_exported') == '2019 Hawaii/darktable_exported'
+    assert album_name('/photos/DCIM/100CANON') is None
+    assert album_name('/photos/New folder (2)') is None
+
+
+@trio.testing.trio_test
+async def test_find_dirs(tmp_path):
+    for dir_path in ('a', 'b/darktable_exported', 'b/100CANON', 'c/.smog', 'empty/d'):
+        (tmp_path / dir_path).mkdir(parents=True)
+    for path in ('a/1.jpg', 'b/2.jpg', 'b/darktable_exported/2.jpg', 'b/100CANON/3.jpg',
+                 'c/.smog/4.jpg', 'empty/d/notes.txt'):
+        (tmp_path / path).write_bytes(b'x')
+    (tmp_path / 'synced').mkdir()
+    (tmp_path / 'synced' / '5.jpg').write_bytes(b'x')
+    (tmp_path / 'synced' / '.smog').mkdir()
+    (tmp_path / 'synced' / '.smog' / 'albumkey').write_text('abc')
+
+    dir_by_name, dir_by_albumkey = await find_dirs([], [str(tmp_path)])
+    assert sorted(dir_by_name) == ['a', 'b', 'b/darktable_exported']
+    assert str(dir_by_name['b/darktable_exported'].dir_path) == str(tmp_path / 'b' / 'darktable_exported')
+    assert list(dir_by_albumkey) == ['abc']
+
+    def only_a(dir_path):
+        return 'A' if dir_path.endswith('/a') else None
+    dir_by_name, dir_by_albumkey = await find_dirs([str(tmp_path / 'a')], [], dir_filter=only_a)
+    assert list(dir_by_name) == ['A']
+    assert dir_by_albumkey == {}
@@ -0,0 +1,64 @@
+import functools
+
+import h11
+import trio
+import trio.testing
+
+from smog import http
+
+
+async def serve_echo_length(stream, connections):
+    # Respond to each request with the length of its body
+    connections.append(stream)
+    conn = h11.Connection(h11.SERVER)
+    while True:
+        length = 0
+        while True:
+            event = conn.next_event()
+            if event is h11.NEED_DATA:
+                data = await stream.receive_some(65536)
+                if not data:
+                    return
+                conn.receive_data(data)
+            elif isinstance(event, h11.Data):
+                length += len(event.data)
+            elif isinstance(event, h11.EndOfMessage):
+                break
+        content = str(length).encode()
+        await stream.send_all(conn.send(h11.Response(status_code=200, headers=[('Content-Length', str(len(content)))])))
+        await stream.send_all(conn.send(h11.Data(data=content)))
+        await stream.send_all(conn.send(h11.EndOfMessage()))
+        if conn.our_state is not h11.DONE:
+            await stream.aclose()
+            return
+        conn.start_next_cycle()
+
+
+async def chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@trio.testing.trio_test
+async def test_session_reuses_connection():
+    connections = []
+    async with trio.open_nursery() as nursery:
+        listeners = await nursery.start(functools.partial(
+            trio.serve_tcp, lambda stream: serve_echo_length(stream, connections), 0, host='127.0.0.1'))
+        port = listeners[0].socket.getsockname()[1]
+        session = http.Session(f'http://127.0.0.1:{port}/', connections=1)
+        for body in (b'a', b'bb', b'ccc'):
+            response = await session.request('POST', f'http://127.0.0.1:{port}/',
+                                             headers={'Content-Length': str(len(body))},
+                                             body=chunks(body[:1], body[1:]))
+            assert response.status_code == 200
+            assert response.content == str(len(body)).encode()
+        assert len(connections) == 1
+
+        response = await http.request('POST', f'http://127.0.0.1:{port}/',
+                                      headers={'Content-Length': '4'}, body=chunks(b'dddd'))
+        assert response.content == b'4'
+        assert len(connections) == 2
+
+        await session.aclose()
+        nursery.cancel_scope.cancel()
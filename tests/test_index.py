@@ -0,0 +1,94 @@
+import hashlib
+
+import trio
+import trio.testing
+
+import smog.index
+from smog.api import SmugMugApi
+from smog.index import AlbumIndex, DirectoryIndex
+
+
+@trio.testing.trio_test
+async def test_directory_index(monkeypatch, tmp_path):
+    (tmp_path / 'a.jpg').write_bytes(b'a')
+    (tmp_path / 'b.MOV').write_bytes(b'b' * 3000000)
+    (tmp_path / 'c.txt').write_bytes(b'c')
+
+    hashed = []
+    md5_path = smog.index.md5_path
+    async def counting_md5_path(path, limiter=None):
+        hashed.append(trio.Path(path).name)
+        return await md5_path(path, limiter)
+    monkeypatch.setattr(smog.index, 'md5_path', counting_md5_path)
+
+    dir_index = DirectoryIndex(tmp_path, trio.CapacityLimiter(2))
+    await dir_index.reindex()
+    assert sorted(hashed) == ['a.jpg', 'b.MOV']
+    assert [x async for x in dir_index.iter_by_md5()] == sorted([
+        (hashlib.md5(b'a').hexdigest(), 'a.jpg'),
+        (hashlib.md5(b'b' * 3000000).hexdigest(), 'b.MOV'),
+    ])
+
+    # Unchanged files are not hashed again, even by a fresh index
+    hashed.clear()
+    await DirectoryIndex(tmp_path).reindex()
+    assert hashed == []
+
+
+class MockListImages(object):
+    def __init__(self, images, page_size=1):
+        self.images = images
+        self.page_size = page_size
+        self.requests = []
+
+    async def __call__(self, endpoint, start=None, count=None, fields=None):
+        self.requests.append((endpoint, start, count))
+        start = start or 1
+        count = count or self.page_size
+        return {'Response': {'AlbumImage': self.images[start - 1:start - 1 + count],
+                             'Pages': {'Total': len(self.images), 'Start': start,
+                                       'Count': len(self.images[start - 1:start - 1 + count]),
+                                       'RequestedCount': count}}}
+
+
+@trio.testing.trio_test
+async def test_album_index_skips_unchanged_albums(tmp_path):
+    a, b = 'a' * 32, 'b' * 32
+    images = [{'ArchivedMD5': b, 'Uri': '/api/v2/album/album0/image/b-0', 'Keywords': 'smog.upload; smog.removed'},
+              {'ArchivedMD5': a, 'Uri': '/api/v2/album/album0/image/a-0', 'Keywords': 'smog.upload'}]
+    expected = [(a, '/api/v2/album/album0/image/a-0'), (b, '/api/v2/album/album0/image/b-0')]
+    api = SmugMugApi('consumer key', 'consumer secret', 'token', 'token secret')
+    api.list_images = MockListImages(images)
+    album_index = AlbumIndex(tmp_path / 'album0', api, '/api/v2/album/album0', '2020-01-01T00:00:00+00:00')
+    await album_index.reindex()
+    assert len(api.list_images.requests) == 2
+    assert [x async for x in album_index.iter_by_md5()] == expected
+    assert album_index.removed == {'/api/v2/album/album0/image/b-0'}
+    # 16 byte md5s, a removed flag and the key of each image after the header
+    assert len((tmp_path / 'album0').read_bytes().partition(b'\n')[2]) == 2 * 17 + len('a-0\nb-0')
+
+    album_index = AlbumIndex(tmp_path / 'album0', api, '/api/v2/album/album0', '2020-01-01T00:00:00+00:00')
+    await album_index.reindex()
+    assert len(api.list_images.requests) == 2
+    assert [x async for x in album_index.iter_by_md5()] == expected
+    assert album_index.removed == {'/api/v2/album/album0/image/b-0'}
+
+    api.list_images = MockListImages([])
+    album_index = AlbumIndex(tmp_path / 'album0', api, '/api/v2/album/album0', '2020-01-02T00:00:00+00:00')
+    await album_index.reindex()
+    assert len(api.list_images.requests) == 1
+    assert [x async for x in album_index.iter_by_md5()] == []
+
+    # Once invalidated the album is listed even if its node is unchanged,
+    # but the last listing can still be loaded
+    api.list_images = MockListImages(images)
+    album_index = AlbumIndex(tmp_path / 'album0', api, '/api/v2/album/album0', '2020-01-03T00:00:00+00:00')
+    await album_index.reindex()
+    await album_index.invalidate()
+    cached = AlbumIndex(tmp_path / 'album0', api, '/api/v2/album/album0')
+    await cached.load_cached()
+    assert list(cached.by_md5) == expected
+    api.list_images = MockListImages([])
+    album_index = AlbumIndex(tmp_path / 'album0', api, '/api/v2/album/album0', '2020-01-03T00:00:00+00:00')
+    await album_index.reindex()
+    assert len(api.list_images.requests) == 1
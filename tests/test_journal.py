@@ -0,0 +1,54 @@
+import trio
+import trio.testing
+
+from smog.journal import NOT_DONE, Journal
+
+
+@trio.testing.trio_test
+async def test_journal(tmp_path):
+    calls = []
+    async def upload_image(album_endpoint, image_path, md5):
+        calls.append(image_path)
+        if image_path == 'fail.jpg':
+            raise Exception('interrupted')
+
+    journal = Journal(tmp_path / 'journal')
+    await journal.open()
+    for image_path in ('a.jpg', 'fail.jpg'):
+        msg, fn, *args = await journal.plan(('Uploading', upload_image, '/api/v2/album/album0', image_path, 'md5'))
+        try:
+            await fn(*args)
+        except Exception:
+            pass
+    assert calls == ['a.jpg', 'fail.jpg']
+
+    # A new run skips what completed even without close()
+    journal = Journal(tmp_path / 'journal')
+    await journal.open()
+    assert journal.previous_planned == {('upload_image', '/api/v2/album/album0', 'fail.jpg', 'md5')}
+    assert await journal.plan(('Uploading', upload_image, '/api/v2/album/album0', 'a.jpg', 'md5')) is None
+    assert await journal.plan(('Uploading', upload_image, '/api/v2/album/album0', 'fail.jpg', 'md5')) is not None
+    await journal.close()
+
+    journal = Journal(tmp_path / 'journal')
+    await journal.open()
+    assert journal.previous_done == set()
+    assert journal.previous_planned == {('upload_image', '/api/v2/album/album0', 'fail.jpg', 'md5')}
+
+
+@trio.testing.trio_test
+async def test_journal_not_done(tmp_path):
+    # As in --duplicates report
+    async def upload_image(album_endpoint, image_path, md5):
+        return NOT_DONE
+
+    journal = Journal(tmp_path / 'journal')
+    await journal.open()
+    msg, fn, *args = await journal.plan(('Uploading', upload_image, '/api/v2/album/album0', 'a.jpg', 'md5'))
+    assert await fn(*args) is NOT_DONE
+    await journal.close(compact=False)
+
+    journal = Journal(tmp_path / 'journal')
+    await journal.open()
+    assert journal.previous_planned == {('upload_image', '/api/v2/album/album0', 'a.jpg', 'md5')}
+    assert journal.previous_done == set()
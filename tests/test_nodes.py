@@ -0,0 +1,57 @@
+import trio.testing
+
+from bench.fake_smugmug import FakeSmugMug
+from smog.nodes import NodeCache
+from tests.test_sync import open_fake_api
+
+
+def names(nodes):
+    return sorted(node['Name'] for node in nodes)
+
+
+@trio.testing.trio_test
+async def test_node_cache(tmp_path):
+    server = FakeSmugMug(page_size=2)
+    server.add_folder('Other')
+    photos = server.add_folder('Photos')
+    folder = server.add_folder('2019', photos['NodeID'])
+    albums = [server.add_album(f'album{i}', folder['NodeID']) for i in range(5)]
+
+    async with open_fake_api(server) as api:
+        node_cache = NodeCache(tmp_path / 'nodes')
+        await node_cache.load()
+        assert await node_cache.find_folder(api, 'Photos/2019') == folder['Uri']
+        assert names(await node_cache.list_children(api, folder['Uri'])) == [f'album{i}' for i in range(5)]
+        await node_cache.save()
+
+        # The next run checks the folder with one GET and sees nothing new
+        # on the first page
+        server.requests.clear()
+        node_cache = NodeCache(tmp_path / 'nodes')
+        await node_cache.load()
+        assert await node_cache.find_folder(api, 'Photos/2019/') == folder['Uri']
+        assert names(await node_cache.list_children(api, folder['Uri'])) == [f'album{i}' for i in range(5)]
+        assert server.requests == {'get node': 1, 'list nodes': 1}
+
+        # New, renamed and modified albums are picked up from the newest
+        server.add_album('new', folder['NodeID'])
+        albums[1]['Name'] = 'renamed'
+        server.revision += 1
+        albums[1]['DateModified'] = str(server.revision)
+        server.add_image(albums[2]['NodeID'], 'md5')
+        server.requests.clear()
+        nodes = await node_cache.list_children(api, folder['Uri'])
+        assert names(nodes) == ['album0', 'album2', 'album3', 'album4', 'new', 'renamed']
+        assert next(node for node in nodes if node['Name'] == 'album2')['DateModified'] == albums[2]['DateModified']
+        assert server.requests['list nodes'] == 2
+
+        # Deleted albums make the count wrong, so everything is listed
+        server.remove_node(albums[3]['NodeID'], folder['NodeID'])
+        assert names(await node_cache.list_children(api, folder['Uri'])) == [
+            'album0', 'album2', 'album4', 'new', 'renamed']
+
+        # Moved folders are looked up again
+        server.nodes[folder['NodeID']]['Name'] = '2019 moved'
+        server.requests.clear()
+        assert await node_cache.find_folder(api, 'Photos/2019 moved') == folder['Uri']
+        assert server.requests['authuser'] == 1
@@ -0,0 +1,52 @@
+import hashlib
+import json
+
+import trio.testing
+
+from bench.fake_smugmug import FakeSmugMug
+from smog.__main__ import parse_args, sync
+from tests.test_sync import album_md5s, open_fake_api
+
+
+@trio.testing.trio_test
+async def test_plan_and_apply(monkeypatch, tmp_path):
+    monkeypatch.setenv('ALBUM_PASSWORD', 'password')
+    server = FakeSmugMug()
+    folder = server.add_folder('Photos')
+    existing = server.add_album('existing', folder['NodeID'])
+    server.add_image(existing['NodeID'], hashlib.md5(b'keep').hexdigest())
+    server.add_image(existing['NodeID'], hashlib.md5(b'gone').hexdigest())
+
+    (tmp_path / 'index').mkdir()
+    for name, contents in (('existing', [b'keep', b'new']), ('created', [b'a', b'bb'])):
+        (tmp_path / name).mkdir()
+        for i, content in enumerate(contents):
+            (tmp_path / name / f'{i}.jpg').write_bytes(content)
+    dirs = [str(tmp_path / 'existing'), str(tmp_path / 'created')]
+    plan_path = tmp_path / 'plan.json'
+
+    async with open_fake_api(server) as api:
+        await sync(api, parse_args(['Photos', str(tmp_path / 'index'), *dirs,
+                                    '--plan', str(plan_path), '--bandwidth', '0.000001']))
+        # Only reads
+        assert set(server.requests) <= {'authuser', 'list nodes', 'list images'}
+        plan = json.loads(plan_path.read_text())
+        assert plan['totals'] == {'uploads': 3, 'upload_bytes': 6, 'removals': 1, 'keywords': 1,
+                                  'albums_created': 1, 'estimated_seconds': 6 + 2 / 100}
+        assert plan['albums'] == [existing['Uris']['Album']]
+        assert sorted(op['op'] for op in plan['operations']) == ['create', 'keywords', 'upload']
+
+        server.requests.clear()
+        await sync(api, parse_args(['Photos', str(tmp_path / 'index'), '--apply', str(plan_path)]))
+        assert server.requests['list images'] == 0
+        assert server.requests['upload'] == 3
+        assert server.requests['patch'] == 1
+        assert album_md5s(server, 'created') == sorted(hashlib.md5(x).hexdigest() for x in (b'a', b'bb'))
+
+        # Applied albums are listed again by the next sync, which finds
+        # nothing left to do
+        server.requests.clear()
+        await sync(api, parse_args(['Photos', str(tmp_path / 'index'), *dirs]))
+        assert server.requests['list images'] == 2
+        assert server.requests['upload'] == 0
+        assert server.requests['patch'] == 0
@@ -0,0 +1,20 @@
+import time
+
+import trio
+import trio.testing
+
+from smog.ratelimit import Bandwidth
+
+
+def test_bandwidth(monkeypatch):
+    monkeypatch.setattr(time, 'localtime', lambda: time.struct_time((2020, 1, 1, 23, 30, 0, 2, 1, 0)))
+    assert Bandwidth(100, [(9 * 60, 18 * 60, 1)]).current_rate() == 100
+    assert Bandwidth(None, [(9 * 60, 18 * 60, 1), (22 * 60, 6 * 60, 2)]).current_rate() == 2
+    assert Bandwidth().current_rate() is None
+
+    async def send(bandwidth):
+        for _ in range(10):
+            await bandwidth.acquire(50)
+        return trio.current_time()
+    # 500 bytes at 100 bytes/s, less the initial second's burst
+    assert trio.run(send, Bandwidth(100), clock=trio.testing.MockClock(autojump_threshold=0)) == 4
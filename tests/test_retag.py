@@ -0,0 +1,25 @@
+import hashlib
+
+import trio.testing
+
+from bench.fake_smugmug import FakeSmugMug
+from smog.retag import retag
+from tests.test_sync import open_fake_api
+
+
+@trio.testing.trio_test
+async def test_retag(monkeypatch):
+    monkeypatch.setenv('ALBUM_PASSWORD', 'password')
+    server = FakeSmugMug(page_size=2)
+    folder = server.add_folder('Photos')
+    for name in ('a', 'b'):
+        album = server.add_album(name, folder['NodeID'])
+        for i in range(5):
+            server.add_image(album['NodeID'], hashlib.md5(f'{name}{i}'.encode()).hexdigest())
+    server.albums[album['NodeID']][3]['Keywords'] = 'smog.upload; smog.removed'
+
+    async with open_fake_api(server) as api:
+        await retag(api, 'Photos')
+    # Both albums, and the one image whose keywords differ
+    assert server.requests['patch'] == 3
+    assert server.albums[album['NodeID']][3]['Keywords'] == 'smog.upload'
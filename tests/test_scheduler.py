@@ -0,0 +1,41 @@
+import trio
+import trio.testing
+
+from smog.scheduler import open_scheduler
+
+
+@trio.testing.trio_test
+async def test_scheduler():
+    started = []
+    running = {'bytes': 0, 'max bytes': 0}
+    async def upload_image(name, size):
+        started.append(name)
+        running['bytes'] += size
+        running['max bytes'] = max(running['max bytes'], running['bytes'])
+        await trio.sleep(0.01)
+        running['bytes'] -= size
+    async def set_keywords(name):
+        started.append(name)
+
+    async with open_scheduler(2, 4, 100, 'smallest') as scheduler:
+        for name, size in (('big', 300), ('a', 60), ('c', 80), ('b', 70)):
+            scheduler.submit(('Uploading', upload_image, name, size), size=size)
+        scheduler.submit(('Marking', set_keywords, 'keywords'))
+    # The PATCH doesn't wait for uploads, which go smallest first and at
+    # most 100 bytes at a time unless a single file is bigger
+    assert started.index('keywords') <= 1
+    assert [name for name in started if name != 'keywords'] == ['a', 'b', 'c', 'big']
+    assert running['max bytes'] == 300
+    assert scheduler.progress == [5, 5]
+
+
+@trio.testing.trio_test
+async def test_scheduler_fair():
+    started = []
+    async def upload_image(name):
+        started.append(name)
+
+    async with open_scheduler(1, 1, 100, 'fair') as scheduler:
+        for name in ('a1', 'a2', 'a3', 'b1', 'b2'):
+            scheduler.submit(('Uploading', upload_image, name), size=1, group=name[0])
+    assert started == ['a1', 'b1', 'a2', 'b2', 'a3']
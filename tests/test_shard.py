@@ -0,0 +1,47 @@
+import hashlib
+import json
+
+import trio.testing
+
+from bench.fake_smugmug import FakeSmugMug
+from smog.__main__ import parse_args, split_limits, sync
+from smog.shard import in_shard, shard_of
+from tests.test_sync import album_md5s, open_fake_api
+
+
+def test_shard_of():
+    assert shard_of('album0', 4) == shard_of('album0', 4)
+    assert {shard_of(f'album{i}', 4) for i in range(100)} == {0, 1, 2, 3}
+    assert in_shard(None, 'album0')
+    assert sum(in_shard((i, 3), 'album0') for i in range(3)) == 1
+
+
+@trio.testing.trio_test
+async def test_shards(monkeypatch, tmp_path):
+    monkeypatch.setenv('ALBUM_PASSWORD', 'password')
+    server = FakeSmugMug()
+    folder = server.add_folder('Photos')
+    names = [f'album{i}' for i in range(8)]
+    for name in names[:4]:
+        server.add_album(name, folder['NodeID'])
+    (tmp_path / 'index').mkdir()
+    for name in names:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / '0.jpg').write_bytes(name.encode())
+    argv = ['Photos', str(tmp_path / 'index'), *(str(tmp_path / name) for name in names), '--shards', '2']
+
+    async with open_fake_api(server) as api:
+        uploads = []
+        for shard in range(2):
+            args = parse_args([*argv, '--shard', f'{shard}/2', '--shard-results', str(tmp_path / f'{shard}.json')])
+            split_limits(args, 2)
+            server.requests.clear()
+            await sync(api, args)
+            uploads.append(server.requests['upload'])
+            assert json.loads((tmp_path / f'{shard}.json').read_text())['progress'][0] > 0
+    # Each album was synced by exactly one of the shards
+    assert sum(uploads) == 8 and all(uploads)
+    for name in names:
+        assert album_md5s(server, name) == [hashlib.md5(name.encode()).hexdigest()]
+    assert (tmp_path / 'index' / 'journal.0').exists()
+    assert (tmp_path / 'index' / 'journal.1').exists()
@@ -0,0 +1,30 @@
+import trio
+import trio.testing
+
+from smog.store import IndexStore
+
+
+@trio.testing.trio_test
+async def test_index_store(tmp_path):
+    store = IndexStore(tmp_path / 'smog.sqlite')
+    await store.update_files('/photos', [('a.jpg', 1, 10, 'aa'), ('b.jpg', 2, 20, 'bb'),
+                                         ('copy of b.jpg', 2, 20, 'bb')])
+    await store.update_album('album0', '2020-01-01', [('aa', '/image/a'), ('cc', '/image/c')])
+    assert await store.load_files('/photos') == {(1, 10, 'a.jpg'): 'aa', (2, 20, 'b.jpg'): 'bb',
+                                                 (2, 20, 'copy of b.jpg'): 'bb'}
+    assert await store.album_last_updated('album0') == '2020-01-01'
+    assert await store.album_last_updated('album1') is None
+    assert await store.diff('/photos', 'album0') == ([('bb', 'b.jpg'), ('bb', 'copy of b.jpg')],
+                                                     [('cc', '/image/c')])
+
+    await store.update_files('/photos', [('a.jpg', 1, 10, 'aa'), ('c.jpg', 3, 30, 'cc')])
+    await store.update_album('album0', '2020-01-02', [('aa', '/image/a'), ('bb', '/image/b')])
+    assert await store.album_by_md5('album0') == [('aa', '/image/a'), ('bb', '/image/b')]
+    assert await store.diff('/photos', 'album0') == ([('cc', 'c.jpg')], [('bb', '/image/b')])
+    await store.update_album('album1', None, [('aa', '/image/a1'), ('bb', '/image/b1')], {'/image/a1'})
+    assert await store.album_removed('album1') == {'/image/a1'}
+    assert await store.find_images('aa') == [('album0', '/image/a')]
+    await store.invalidate_album('album0')
+    assert await store.album_last_updated('album0') is None
+    assert await store.album_by_md5('album0') == [('aa', '/image/a'), ('bb', '/image/b')]
+    await store.close()
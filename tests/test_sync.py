@@ -0,0 +1,69 @@
+import functools
+import hashlib
+
+import trio
+import trio.testing
+from async_generator import asynccontextmanager
+
+from bench.fake_smugmug import FakeSmugMug
+from smog.__main__ import CONCURRENCY, parse_args, sync
+from smog.api import SmugMugApi
+
+
+@asynccontextmanager
+async def open_fake_api(server):
+    async with trio.open_nursery() as nursery:
+        listeners = await nursery.start(functools.partial(trio.serve_tcp, server.handle, 0, host='127.0.0.1'))
+        port = listeners[0].socket.getsockname()[1]
+        api = SmugMugApi('consumer key', 'consumer secret', 'token', 'token secret')
+        api.BASE_URI = f'http://127.0.0.1:{port}'
+        api.UPLOAD_URI = f'http://127.0.0.1:{port}/'
+        async with api.open_sessions(CONCURRENCY):
+            yield api
+        nursery.cancel_scope.cancel()
+
+
+def album_md5s(server, name):
+    node = next(node for node in server.nodes.values() if node['Name'] == name)
+    return sorted(image['ArchivedMD5'] for image in server.albums[node['NodeID']])
+
+
+@trio.testing.trio_test
+async def test_sync(monkeypatch, tmp_path):
+    monkeypatch.setenv('ALBUM_PASSWORD', 'password')
+    server = FakeSmugMug()
+    folder = server.add_folder('Photos')
+    existing = server.add_album('existing', folder['NodeID'])
+    server.add_image(existing['NodeID'], hashlib.md5(b'keep').hexdigest())
+    server.add_image(existing['NodeID'], hashlib.md5(b'gone').hexdigest())
+
+    (tmp_path / 'index').mkdir()
+    for name, contents in (('existing', [b'keep', b'new']), ('created', [b'a', b'b'])):
+        (tmp_path / name).mkdir()
+        for i, content in enumerate(contents):
+            (tmp_path / name / f'{i}.jpg').write_bytes(content)
+    args = parse_args(['Photos', str(tmp_path / 'index'), str(tmp_path / 'existing'), str(tmp_path / 'created')])
+
+    async with open_fake_api(server) as api:
+        await sync(api, args)
+        assert album_md5s(server, 'existing') == sorted(hashlib.md5(x).hexdigest() for x in (b'keep', b'gone', b'new'))
+        assert album_md5s(server, 'created') == sorted(hashlib.md5(x).hexdigest() for x in (b'a', b'b'))
+        assert server.requests['upload'] == 3
+        assert server.requests['patch'] == 1
+
+        # Albums this run changed are listed again next run
+        server.requests.clear()
+        await sync(api, args)
+        assert server.requests['upload'] == 0
+        assert server.requests['list images'] == 2
+
+        # Unchanged albums are not, and without the journal nothing is sent
+        (tmp_path / 'index' / 'journal').unlink()
+        server.requests.clear()
+        await sync(api, args)
+        assert server.requests['list images'] == 0
+        assert server.requests['upload'] == 0
+        assert server.requests['patch'] == 0
+        # and the folder and its albums come from the node cache
+        assert server.requests['authuser'] == 0
+        assert server.requests['list nodes'] == 1
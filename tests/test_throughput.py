@@ -0,0 +1,20 @@
+import trio
+import trio.testing
+
+from smog.throughput import Throughput
+
+
+def test_throughput():
+    async def upload():
+        throughput = Throughput()
+        throughput.plan('album0', 3000)
+        throughput.plan('album1', 1000)
+        assert throughput.eta() is None
+        for _ in range(10):
+            await trio.sleep(1)
+            throughput.sent('album0', 100)
+        throughput.finish('album0', 3000)
+        assert throughput.rate() == 100
+        assert throughput.eta() == 10
+        assert list(throughput.album_totals()) == [('album0', 0.001, 0.003), ('album1', 0, 0.001)]
+    trio.run(upload, clock=trio.testing.MockClock(autojump_threshold=0))
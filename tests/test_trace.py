@@ -0,0 +1,33 @@
+import json
+import time
+
+import trio
+
+from smog.api import endpoint_class
+from smog.trace import BlockingInstrument, Tracer, tracer
+
+
+def test_tracer(tmp_path):
+    trace = Tracer()
+    trace.open(tmp_path / 'trace')
+    with trace.span('request', 'GET /api/v2/album/*!images') as fields:
+        fields['status'] = 200
+    trace.count('md5 cache hits', 3)
+    trace.count('md5 cache misses')
+    trace.close()
+    record, = map(json.loads, (tmp_path / 'trace').read_text().splitlines())
+    assert record['kind'] == 'request'
+    assert record['status'] == 200
+    summary = trace.summary()
+    assert summary[0].startswith('request   GET /api/v2/album/*!images')
+    assert 'md5 cache hit ratio 75.0% (3 of 4)' in summary
+
+    assert endpoint_class('https://api.smugmug.com/api/v2/album/abc!images?start=1') == '/api/v2/album/*!images'
+    assert endpoint_class('https://upload.smugmug.com/') == 'upload'
+
+
+def test_blocking_instrument():
+    async def block():
+        time.sleep(0.05)
+    trio.run(block, instruments=[BlockingInstrument(0.01)])
+    assert any(kind == 'blocking' for kind, _ in tracer.stats)
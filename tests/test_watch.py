@@ -0,0 +1,53 @@
+import hashlib
+
+import trio
+import trio.testing
+
+import smog.__main__
+from bench.fake_smugmug import FakeSmugMug
+from smog.__main__ import parse_args, sync
+from smog.inotify import Inotify
+from tests.test_sync import album_md5s, open_fake_api
+
+
+@trio.testing.trio_test
+async def test_inotify(tmp_path):
+    with Inotify() as inotify:
+        inotify.add_watch(str(tmp_path))
+        (tmp_path / 'a.jpg').write_bytes(b'a')
+        (tmp_path / 'a.jpg').unlink()
+        assert set(await inotify.read()) == {(str(tmp_path), 'a.jpg')}
+
+
+@trio.testing.trio_test
+async def test_watch(monkeypatch, tmp_path):
+    monkeypatch.setenv('ALBUM_PASSWORD', 'password')
+    monkeypatch.setattr(smog.__main__, 'WATCH_QUIET', 0.1)
+    server = FakeSmugMug()
+    server.add_folder('Photos')
+    (tmp_path / 'index').mkdir()
+    (tmp_path / 'album').mkdir()
+    (tmp_path / 'album' / '0.jpg').write_bytes(b'a')
+    args = parse_args(['Photos', str(tmp_path / 'index'), str(tmp_path / 'album'), '--watch'])
+
+    async with open_fake_api(server) as api:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(sync, api, args)
+            with trio.fail_after(10):
+                while server.requests['upload'] < 1:
+                    await trio.sleep(0.01)
+            # Let watch start before changing anything
+            await trio.sleep(0.1)
+            (tmp_path / 'album' / '1.jpg').write_bytes(b'b')
+            (tmp_path / 'album' / '0.jpg').unlink()
+            with trio.fail_after(10):
+                while server.requests['upload'] < 2 or server.requests['patch'] < 1:
+                    await trio.sleep(0.01)
+            # Nothing is sent again on later changes
+            (tmp_path / 'album' / 'ignored.txt').write_bytes(b'c')
+            await trio.sleep(0.3)
+            nursery.cancel_scope.cancel()
+
+    assert album_md5s(server, 'album') == sorted(hashlib.md5(x).hexdigest() for x in (b'a', b'b'))
+    assert server.requests['upload'] == 2
+    assert server.requests['patch'] == 1